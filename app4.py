@@ -1,10 +1,37 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
 import time
 import smtplib
 from email.mime.text import MIMEText
 import random
+import threading
+import json
+import re
+from datetime import datetime
+import sqlite3
+import queue
+import itertools
+from functools import partial, wraps
+import cProfile
+import io
+import pstats
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import os
+import tempfile
+import socket
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+import pyarrow as pa
+import pyarrow.parquet as pq
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+try:
+    from pypinyin import lazy_pinyin, Style  # 選用：有安裝才會建立拼音 / 注音搜尋鍵
+except ImportError:
+    lazy_pinyin = None
 
 # ==========================================
 # 1. 設定區
@@ -26,200 +53,2043 @@ TABLE_ID_INVENTORY = 'DB_Inventory'
 TABLE_ID_FEEDBACK = 'DB_Feedback'
 TABLE_ID_WISHLIST = 'DB_Wishlist'
 
-headers = {'Authorization': f'Bearer {CODA_API_KEY}'}
+CODA_API_BASE = st.secrets.get("CODA_API_BASE", 'https://coda.io/apis/v1')  # 測試時可指向本機的 fake_coda.py
+CODA_PAGE_SIZE = 500  # Coda 單頁上限
+CODA_TIMEOUT = 15      # 單次請求逾時 (秒)
+CODA_MAX_RETRIES = 4   # 429 / 5xx / 斷線時最多重試次數
+CODA_MAX_BACKOFF = 8.0 # 單次退避等待上限 (秒)
+
+# 鏡像：同一台主機上的多個副本可把 MIRROR_PATH 指向同一個本機檔案；跨主機的副本請設定 SHARED_CACHE_URL=redis://... 改用 Redis，
+# 不要把 SQLite 檔放在 NFS / SMB 等網路磁碟上 (WAL 模式的共用記憶體索引只在單一主機有效，跨主機會鎖定失敗甚至損毀)。
+# 同一張表同一時間只會有一個副本向 Coda 同步
+MIRROR_PATH = st.secrets.get("MIRROR_PATH", "coda_mirror.sqlite3")  # SQLite 鏡像檔
+SHARED_CACHE_URL = st.secrets.get("SHARED_CACHE_URL", "")  # 留空則使用 MIRROR_PATH
+MIRROR_FULL_RESYNC = 3600  # 每隔多久整表重抓一次，用來清掉在 Coda 端被刪除的列 (秒)
+MIRROR_LEASE_TTL = 120     # 同步租約的有效時間，持有者當掉時別的副本最久等這麼久接手 (秒)
+OUTBOX_PATH = st.secrets.get("OUTBOX_PATH", "coda_outbox.sqlite3")  # 寫入佇列 (每個副本各自一份，勿共用)
+
+SNAPSHOT_DIR = st.secrets.get("SNAPSHOT_DIR", "snapshots")  # 資料表的 Parquet 快照目錄，重啟或 Coda 連不上時先用快照；留空則不寫快照
+STALE_NOTICE_AFTER = 120       # 資料比該表的更新間隔還舊這麼多秒時，在頁首提示使用者 (秒)
+
+REFRESH_RETRY = 5              # 背景同步失敗後多久再試 (秒)
+INVENTORY_QUERY_TTL = 30       # 庫存窄查詢 (單一藥品 / 縣市) 結果的快取時間 (秒)
+INVENTORY_QUERY_ENTRIES = 256  # 最多快取幾組窄查詢結果
+TABLE_WAIT_POLL = 2            # 冷啟動時資料表還在背景載入，頁面多久檢查一次是否已到手 (秒)
+MANUAL_REFRESH_INTERVAL = 30   # 「🔄 刷新」每張表最短間隔 (秒)
+
+RESULT_PAGE_SIZES = [10, 20, 50]  # 找藥結果每次顯示 / 載入更多的筆數
+
+# 「離我最近」：診所座標取自 CLINIC_GEOCODE_PATH (CSV，欄位 機構代碼,緯度,經度)，查不到的診所以所在縣市的中心點代替；
+# 縣市中心點可在 DB_Cities 加上「緯度」「經度」欄覆寫下方的預設值
+CLINIC_GEOCODE_PATH = st.secrets.get("CLINIC_GEOCODE_PATH", "clinic_geocode.csv")
+NEARBY_RADII = [2, 5, 10, 20, 50]  # 可選的搜尋半徑 (公里)
+NEARBY_OPTION = "📍 離我最近"      # 縣市選單中的「依距離排序」選項
+GEO_CELL_KM = 5                    # 空間索引每格的邊長 (公里)
+CITY_CENTROIDS = {
+    "臺北市": (25.0375, 121.5637), "新北市": (25.0120, 121.4657), "桃園市": (24.9937, 121.3010), "臺中市": (24.1477, 120.6736),
+    "臺南市": (22.9999, 120.2270), "高雄市": (22.6273, 120.3014), "基隆市": (25.1276, 121.7392), "新竹市": (24.8138, 120.9675),
+    "嘉義市": (23.4801, 120.4491), "新竹縣": (24.8387, 121.0177), "苗栗縣": (24.5602, 120.8214), "彰化縣": (24.0518, 120.5161),
+    "南投縣": (23.9096, 120.6847), "雲林縣": (23.7092, 120.4313), "嘉義縣": (23.4518, 120.2555), "屏東縣": (22.6690, 120.4862),
+    "宜蘭縣": (24.7021, 121.7378), "花蓮縣": (23.9872, 121.6016), "臺東縣": (22.7583, 121.1444), "澎湖縣": (23.5711, 119.5793),
+    "金門縣": (24.4321, 118.3171), "連江縣": (26.1602, 119.9517),
+}
+
+WRITE_FLUSH_INTERVAL = 2.0  # 寫入佇列最久等多久送出一批 (秒)
+WRITE_BATCH_SIZE = 50       # 累積到這麼多筆就立即送出
+WRITE_CHUNK_ROWS = 100      # 單次 Coda insert 最多帶幾列
+WRITE_MAX_BACKOFF = 300     # 寫入失敗後重試的最長間隔 (秒)
+WRITE_VERIFY_AFTER = 60     # 5xx / 逾時後不知道 Coda 有沒有寫入，等這麼久 (Coda 非同步寫入) 再到鏡像核對，沒有才重送 (秒)
+WRITE_FAILED_KEEP = 7 * 86400  # 寫入失敗 (資料有誤) 的列保留多久供維運頁查看 (秒)
+SUPPLY_KEY_COLUMNS = ["機構代碼", "提供藥品"]  # DB_Supply_Inbox 的 upsert 鍵：同一診所同一藥品重送時更新原列
+SUPPLY_BATCH_MAX = 200      # 批次供貨一次最多幾列
+SUPPLY_DRUG_COLUMNS = ("藥品", "藥品名稱", "提供藥品")  # 批次供貨 CSV 中可當作藥名的欄位
+
+VOTE_SYNC_INTERVAL = 10  # 計票器多久向 Coda 同步一次 DB_Requests 的變動 (秒)
+TREND_WINDOWS = {"24 小時": 24, "7 天": 24 * 7, "30 天": 24 * 30}  # 熱度排行榜的時間區間 (小時)
+TREND_MAX_HOURS = 24 * 30      # 每小時的票數桶最多保留多久 (小時)；全期票數另外累計，不受影響
+TREND_HALF_LIFE = 3 * 86400    # 「趨勢」分數的半衰期：一票的權重每隔這麼久減半 (秒)
+
+# 寄信設定：測試時可把 SMTP_HOST / SMTP_PORT 指向本機的 SMTP 替身，並把 SMTP_STARTTLS 設為 false
+SMTP_HOST = st.secrets.get("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(st.secrets.get("SMTP_PORT", 587))
+SMTP_STARTTLS = str(st.secrets.get("SMTP_STARTTLS", True)).lower() not in ("false", "0", "no")
+MAIL_WORKERS = 2         # 寄信背景執行緒數 (各自保有一條 SMTP 連線)
+MAIL_QUEUE_SIZE = 200    # 等待寄出的信件上限，滿了就拒收
+MAIL_MAX_ATTEMPTS = 3    # 每封信最多嘗試次數
+MAIL_IDLE_CLOSE = 60     # SMTP 連線閒置多久後關閉 (秒)
+MAIL_TIMEOUT = 20        # SMTP 連線逾時 (秒)
+
+# 到貨通知：定期比對 DB_Inventory 的變動，某縣市的某藥品從無貨變成有貨且上架時，寄信給許願過的人
+RESTOCK_NOTIFY_INTERVAL = int(st.secrets.get("RESTOCK_NOTIFY_INTERVAL", 60))  # 多久檢查一次 (秒)；0 表示關閉
+RESTOCK_NOTIFY_PATH = st.secrets.get("RESTOCK_NOTIFY_PATH", "restock_notify.sqlite3")  # 已寄通知紀錄；同一台主機的多個副本請指向同一個檔案
+RESTOCK_HOST_LEASE_TTL = int(st.secrets.get("RESTOCK_HOST_LEASE_TTL", 3600))  # 寄送紀錄只在本機，同時只有一台主機寄通知；它停擺這麼久後才由別台接手 (秒)
+RESTOCK_RENOTIFY_AFTER = 7 * 86400  # 同一人同一藥品 / 縣市至少隔這麼久才再通知 (秒)
+RESTOCK_MAILS_PER_DAY = 3           # 每人每 24 小時最多收幾封到貨通知，超過的留到之後合併寄出
+RESTOCK_MAILS_PER_RUN = 50          # 每輪最多排入幾封，避免佔滿寄信佇列 (驗證碼優先)
+APP_URL = st.secrets.get("APP_URL", "")  # 通知信中附上的網址，留空則不附
+
+# 沒有真人 Email 的許願 / 投票寫進 DB_Requests 時用的佔位地址，不會收到任何通知
+ANONYMOUS_WISH_EMAIL = "anonymous@wish"   # 許願時沒留 Email
+NEW_ARRIVAL_VOTE_EMAIL = "new_arrival@vote"  # 新藥上架時的投票
+PLUS_ONE_VOTE_EMAIL = "plus1@vote"        # 「幫我集氣 +1」
+PLACEHOLDER_EMAILS = {ANONYMOUS_WISH_EMAIL, NEW_ARRIVAL_VOTE_EMAIL, PLUS_ONE_VOTE_EMAIL}
+EMAIL_PATTERN = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s.]{2,}")
+
+ADMIN_TOKEN = st.secrets.get("ADMIN_TOKEN", "")       # 維運頁 (網址加 ?admin=<token>) 的通行碼，留空則不開放
+METRICS_PORT = int(st.secrets.get("METRICS_PORT", 0))  # 大於 0 時在這個埠提供 Prometheus 格式的 /metrics
+METRICS_WINDOW = 1000    # 每個計時項目保留最近幾筆樣本來算 p50 / p99
 
 # ==========================================
 # 2. 核心函式
 # ==========================================
 
-@st.cache_data(ttl=60)
+class Metrics:
+    """
+    行程內共用的效能指標 (所有 session 與背景執行緒共用)。
+    計時項目各保留最近 METRICS_WINDOW 筆樣本算 p50 / p99，另有累計次數與總耗時；
+    計數器以 (名稱, 標籤) 區分。prometheus() 輸出 Prometheus 文字格式。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+        self._totals = defaultdict(lambda: [0, 0.0])  # name -> [次數, 總毫秒]
+        self._counters = Counter()
+        self.last_profile = None
+
+    def observe(self, name, ms):
+        with self._lock:
+            self._samples[name].append(ms)
+            total = self._totals[name]
+            total[0] += 1; total[1] += ms
+
+    def since(self, name, start):
+        """記錄從 start (time.perf_counter()) 到現在的耗時"""
+        self.observe(name, (time.perf_counter() - start) * 1000)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.since(name, start)
+
+    def incr(self, name, n=1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += n
+
+    def summary(self):
+        """各計時項目的 count / p50 / p99 / max / total (毫秒)，依名稱排序"""
+        with self._lock:
+            items = [(name, sorted(samples), *self._totals[name]) for name, samples in self._samples.items()]
+        return [{'name': name, 'count': count, 'p50_ms': s[(len(s) - 1) // 2], 'p99_ms': s[int((len(s) - 1) * 0.99)],
+                 'max_ms': s[-1], 'total_ms': total} for name, s, count, total in sorted(items)]
+
+    def counters(self):
+        with self._lock:
+            return [{'name': name, **dict(labels), 'value': value} for (name, labels), value in sorted(self._counters.items())]
+
+    def prometheus(self):
+        def label_text(pairs):
+            return ','.join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in pairs)
+
+        lines = ['# TYPE drug_finder_duration_ms summary']
+        for s in self.summary():
+            name = label_text([('name', s['name'])])
+            lines += [f'drug_finder_duration_ms{{{name},quantile="0.5"}} {s["p50_ms"]:.3f}',
+                      f'drug_finder_duration_ms{{{name},quantile="0.99"}} {s["p99_ms"]:.3f}',
+                      f'drug_finder_duration_ms_sum{{{name}}} {s["total_ms"]:.3f}',
+                      f'drug_finder_duration_ms_count{{{name}}} {s["count"]}']
+        with self._lock:
+            counters = sorted(self._counters.items())
+        for metric in sorted({name for (name, _), _ in counters}):
+            lines.append(f'# TYPE drug_finder_{metric}_total counter')
+            lines += [f'drug_finder_{name}_total{{{label_text(labels)}}} {value}' for (name, labels), value in counters if name == metric]
+        return '\n'.join(lines) + '\n'
+
+def serve_metrics(port, metrics):
+    """在背景執行緒以 HTTP 提供 GET /metrics (Prometheus 文字格式)"""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+@st.cache_resource
+def get_metrics():
+    metrics = Metrics()
+    if METRICS_PORT: serve_metrics(METRICS_PORT, metrics)
+    return metrics
+
+def instrumented(func):
+    """記錄每次呼叫 func 的耗時，計時名稱為函式名；放在 st.cache_resource 下面時只有快取沒命中 (重建) 才會計時"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with get_metrics().timer(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def rows_url(table_id):
+    return f'{CODA_API_BASE}/docs/{DOC_ID}/tables/{table_id}/rows'
+
+class CodaClient:
+    """
+    全站共用的 Coda API 連線 (keep-alive 連線池，可跨執行緒使用)。
+    遇到 429 / 5xx / 斷線會以隨機退避重試，有 Retry-After 時優先遵守；
+    並依端點累計呼叫次數、錯誤次數與延遲，供 stats() 查詢 (每次呼叫也記進 metrics)。
+    """
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, api_key, metrics):
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+        self.session.mount('https://', adapter); self.session.mount('http://', adapter)
+        self.session.headers.update({'Authorization': f'Bearer {api_key}'})
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def get(self, table_id, params=None):
+        return self.request('GET', table_id, params=params)
+
+    def post(self, table_id, payload):
+        return self.request('POST', table_id, json=payload)
+
+    def request(self, method, table_id, **kwargs):
+        endpoint = f'{method} {table_id}'
+        # 寫入只在 429 (Coda 尚未處理) 時重試，避免 5xx 後重送造成重複資料
+        retry_status = self.RETRY_STATUS if method == 'GET' else {429}
+        for attempt in range(CODA_MAX_RETRIES + 1):
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, rows_url(table_id), timeout=CODA_TIMEOUT, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                # 寫入只有「連線都沒建立」(ConnectTimeout) 時確定沒送出，其他斷線 / 逾時可能已寫入，交給呼叫端處理
+                safe = method == 'GET' or isinstance(e, requests.ConnectTimeout)
+                self._record(endpoint, start, error=True, retried=safe and attempt < CODA_MAX_RETRIES)
+                if not safe or attempt == CODA_MAX_RETRIES: raise
+                time.sleep(self._backoff(attempt))
+                continue
+            retry = r.status_code in retry_status and attempt < CODA_MAX_RETRIES
+            self._record(endpoint, start, error=r.status_code >= 400, retried=retry)
+            if not retry:
+                r.raise_for_status()
+                return r
+            time.sleep(self._backoff(attempt, r.headers.get('Retry-After')))
+
+    def _backoff(self, attempt, retry_after=None):
+        try: return min(float(retry_after), CODA_MAX_BACKOFF)
+        except (TypeError, ValueError): return random.uniform(0, min(CODA_MAX_BACKOFF, 0.5 * 2 ** attempt))
+
+    def _record(self, endpoint, start, error, retried):
+        ms = (time.perf_counter() - start) * 1000
+        self.metrics.observe(f'coda {endpoint}', ms)
+        self.metrics.incr('coda_requests', endpoint=endpoint, outcome='error' if error else 'ok')
+        with self._lock:
+            rec = self._stats.setdefault(endpoint, {'calls': 0, 'errors': 0, 'retries': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            rec['calls'] += 1; rec['errors'] += error; rec['retries'] += retried
+            rec['total_ms'] += ms; rec['max_ms'] = max(rec['max_ms'], ms)
+
+    def stats(self):
+        """各端點的計數與平均 / 最大延遲 (毫秒)"""
+        with self._lock:
+            return {k: {**v, 'avg_ms': v['total_ms'] / v['calls']} for k, v in self._stats.items()}
+
+@st.cache_resource
+def get_coda_client():
+    return CodaClient(CODA_API_KEY, get_metrics())
+
+def iter_coda_pages(table_id, **params):
+    """
+    依 nextPageToken 逐頁讀取整張表。
+    下一頁在背景執行緒先行抓取，與呼叫端解析目前這一頁的時間重疊。
+    """
+    client = get_coda_client()
+    params = {'useColumnNames': 'true', 'limit': CODA_PAGE_SIZE, **params}
+
+    def fetch(page_params):
+        return client.get(table_id, page_params).json()
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(fetch, params)
+        while pending is not None:
+            data = pending.result()
+            token = data.get('nextPageToken')
+            pending = pool.submit(fetch, {**params, 'pageToken': token}) if token else None
+            yield data
+
+class CodaMirror:
+    """
+    DB_* 資料表的 SQLite 鏡像。
+    第一次整表下載，之後以 Coda 的 syncToken 只拉新增 / 修改過的列並 upsert
+    (updatedAt 沒變的列直接略過)。每次寫入的列都會拿到遞增的 seq，
+    下游可以用 changes_since() 只處理變動的部分；整表重抓時 generation 加一。
+    多個副本可以共用同一個鏡像：同步前先搶該表的租約，同一時間只有一個副本會打 Coda，
+    其他副本直接讀它寫好的結果。SQLite 檔 (WAL 模式) 只能給同一台主機上的副本共用，跨主機請用 RedisMirror。
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.RLock()
+        self._sync_locks = defaultdict(threading.Lock)
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS mirror_rows (
+                table_id TEXT, row_id TEXT, idx INTEGER, updated_at TEXT, item TEXT, seq INTEGER,
+                PRIMARY KEY (table_id, row_id))""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS mirror_rows_seq ON mirror_rows (table_id, seq)")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS mirror_state (
+                table_id TEXT PRIMARY KEY, sync_token TEXT, generation INTEGER, seq INTEGER,
+                synced_at REAL, full_synced_at REAL)""")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS mirror_lease (table_id TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+
+    def sync(self, table_id, max_age=0):
+        """
+        把鏡像更新到最新，回傳這次寫入 (新增或修改) 的列數；max_age 秒內 (任何副本) 同步過就不動。
+        租約在別的副本手上時回傳 None，結果等它寫回鏡像後再讀。
+        """
+        with self._sync_locks[table_id]:
+            if self._fresh(table_id, max_age):
+                return 0
+            if not self._acquire_lease(table_id):
+                return None
+            try:
+                state = self.state(table_id)  # 搶到租約前別的副本可能剛同步完，重讀一次
+                if self._fresh(table_id, max_age, state):
+                    return 0
+                if state and state['sync_token'] and time.time() - state['full_synced_at'] < MIRROR_FULL_RESYNC:
+                    try:
+                        return self._sync_delta(table_id, state)
+                    except requests.HTTPError as e:
+                        # syncToken 過期或失效 (4xx) 時退回整表重抓，其他錯誤照常往外丟
+                        if e.response is None or e.response.status_code >= 500: raise
+                return self._sync_full(table_id, state)
+            finally:
+                self._release_lease(table_id)
+
+    def _fresh(self, table_id, max_age, state=None):
+        state = state or self.state(table_id)
+        return bool(state) and time.time() - state['synced_at'] < max_age
+
+    def _sync_delta(self, table_id, state):
+        seq, token, changed = state['seq'], state['sync_token'], 0
+        for data in iter_coda_pages(table_id, syncToken=state['sync_token']):
+            rows = [(i, seq + k + 1) for k, i in enumerate(data['items'])]
+            seq += len(rows)
+            changed += self._upsert(table_id, rows)
+            token = data.get('nextSyncToken', token)
+        self._save_state(table_id, token, seq, time.time())
+        return changed
+
+    def _sync_full(self, table_id, state):
+        seq = state['seq'] if state else 0
+        generation = state['generation'] + 1 if state else 1
+        items, token = [], None
+        for data in iter_coda_pages(table_id):
+            items.extend(data['items'])
+            token = data.get('nextSyncToken', token)
+        self._replace(table_id, [(i, seq + k + 1) for k, i in enumerate(items)], token, generation, seq + len(items), time.time())
+        return len(items)
+
+    @staticmethod
+    def _dump(item):
+        return json.dumps({k: item.get(k) for k in ('id', 'index', 'name', 'createdAt', 'updatedAt', 'values')}, ensure_ascii=False)
+
+    # ---- 以下為儲存層，RedisMirror 覆寫這些方法 ----
+
+    def _upsert(self, table_id, rows):
+        """rows 為 [(item, seq)]；updatedAt 沒變的列略過，回傳實際寫入的列數"""
+        rows = [(table_id, i['id'], i.get('index'), i.get('updatedAt'), self._dump(i), seq) for i, seq in rows]
+        with self._lock, self.conn:
+            return self.conn.executemany("""INSERT INTO mirror_rows VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (table_id, row_id) DO UPDATE SET
+                    idx = excluded.idx, updated_at = excluded.updated_at, item = excluded.item, seq = excluded.seq
+                WHERE mirror_rows.updated_at IS NOT excluded.updated_at""", rows).rowcount
+
+    def _save_state(self, table_id, token, seq, synced_at):
+        with self._lock, self.conn:
+            self.conn.execute("UPDATE mirror_state SET sync_token = ?, seq = ?, synced_at = ? WHERE table_id = ?",
+                              (token, seq, synced_at, table_id))
+
+    def _replace(self, table_id, rows, token, generation, seq, now):
+        rows = [(table_id, i['id'], i.get('index'), i.get('updatedAt'), self._dump(i), s) for i, s in rows]
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM mirror_rows WHERE table_id = ?", (table_id,))
+            self.conn.executemany("INSERT INTO mirror_rows VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.execute("INSERT OR REPLACE INTO mirror_state VALUES (?, ?, ?, ?, ?, ?)",
+                              (table_id, token, generation, seq, now, now))
+
+    def _acquire_lease(self, table_id, ttl=MIRROR_LEASE_TTL, owner=None):
+        """搶這張表的同步租約 (過期的租約可以直接接手，自己持有的則延長)，成功回傳 True"""
+        now = time.time()
+        with self._lock, self.conn:
+            return self.conn.execute("""INSERT INTO mirror_lease VALUES (?, ?, ?)
+                ON CONFLICT (table_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                WHERE mirror_lease.expires_at < ? OR mirror_lease.owner = excluded.owner""",
+                (table_id, owner or self.owner, now + ttl, now)).rowcount == 1
+
+    def _release_lease(self, table_id, owner=None):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM mirror_lease WHERE table_id = ? AND owner = ?", (table_id, owner or self.owner))
+
+    def acquire_lease(self, name, ttl=MIRROR_LEASE_TTL, owner=None):
+        """
+        供其他背景工作共用的租約 (與同步租約同一套，name 不要和表格 id 重複)。
+        owner 預設為本行程 (主機:pid)；傳主機名稱則同一台主機的所有副本共用這份租約。成功回傳 True。
+        """
+        return self._acquire_lease(name, ttl, owner)
+
+    def release_lease(self, name, owner=None):
+        self._release_lease(name, owner)
+
+    def state(self, table_id):
+        with self._lock:
+            row = self.conn.execute("SELECT sync_token, generation, seq, synced_at, full_synced_at FROM mirror_state WHERE table_id = ?", (table_id,)).fetchone()
+        return dict(zip(('sync_token', 'generation', 'seq', 'synced_at', 'full_synced_at'), row)) if row else None
+
+    def version(self, table_id):
+        """(generation, seq)；鏡像內容有任何變動就會不同，尚未同步過則為 None"""
+        state = self.state(table_id)
+        return (state['generation'], state['seq']) if state else None
+
+    def items(self, table_id):
+        """鏡像內整張表的列 (與 Coda API 回傳的 item 同格式)，依 Coda 表格順序排列"""
+        with self._lock:
+            rows = self.conn.execute("SELECT item FROM mirror_rows WHERE table_id = ? ORDER BY idx", (table_id,)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def _items_since(self, table_id, seq):
+        with self._lock:
+            rows = self.conn.execute("SELECT item FROM mirror_rows WHERE table_id = ? AND seq > ? ORDER BY seq", (table_id, seq)).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def changes_since(self, table_id, version):
+        """
+        回傳 (目前版本, 變動的列, 是否需整批重建)。
+        version 為呼叫端上次看到的 version()；若期間整表重抓過 (generation 不同)，
+        則回傳整張表並要求呼叫端重建。
+        """
+        current = self.version(table_id)
+        if current is None:
+            return None, [], True
+        if version is None or version[0] != current[0]:
+            return current, self.items(table_id), True
+        return current, self._items_since(table_id, version[1]), False
+
+class RedisMirror(CodaMirror):
+    """
+    放在 Redis 的共用鏡像，介面與 CodaMirror 相同，給跨主機的多個副本共用。
+    每張表使用 {prefix}:rows:{table} (row_id → item)、{prefix}:seq:{table} (row_id 依 seq 排序)、
+    {prefix}:state:{table} 與租約 {prefix}:lease:{table} 四個 key。
+    """
+    def __init__(self, url, prefix='drug-finder'):
+        import redis  # 選用套件：只有設定 SHARED_CACHE_URL 為 redis:// 時才需要安裝
+        self.redis = redis
+        self.r = redis.Redis.from_url(url, decode_responses=True)
+        self.prefix = prefix
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._sync_locks = defaultdict(threading.Lock)
+
+    def _key(self, kind, table_id):
+        return f"{self.prefix}:{kind}:{table_id}"
+
+    def _upsert(self, table_id, rows):
+        if not rows: return 0
+        old = self.r.hmget(self._key('rows', table_id), [i['id'] for i, _ in rows])
+        rows = [(i, seq) for (i, seq), prev in zip(rows, old) if prev is None or json.loads(prev).get('updatedAt') != i.get('updatedAt')]
+        if rows:
+            pipe = self.r.pipeline()
+            pipe.hset(self._key('rows', table_id), mapping={i['id']: self._dump(i) for i, _ in rows})
+            pipe.zadd(self._key('seq', table_id), {i['id']: seq for i, seq in rows})
+            pipe.execute()
+        return len(rows)
+
+    def _save_state(self, table_id, token, seq, synced_at):
+        self.r.hset(self._key('state', table_id), mapping={'sync_token': token or '', 'seq': seq, 'synced_at': synced_at})
+
+    def _replace(self, table_id, rows, token, generation, seq, now):
+        pipe = self.r.pipeline()  # MULTI / EXEC：其他副本不會讀到換到一半的表
+        pipe.delete(self._key('rows', table_id), self._key('seq', table_id))
+        if rows:
+            pipe.hset(self._key('rows', table_id), mapping={i['id']: self._dump(i) for i, _ in rows})
+            pipe.zadd(self._key('seq', table_id), {i['id']: s for i, s in rows})
+        pipe.hset(self._key('state', table_id), mapping={'sync_token': token or '', 'generation': generation, 'seq': seq,
+                                                         'synced_at': now, 'full_synced_at': now})
+        pipe.execute()
+
+    def _acquire_lease(self, table_id, ttl=MIRROR_LEASE_TTL, owner=None):
+        key, owner, px = self._key('lease', table_id), owner or self.owner, int(ttl * 1000)
+        if self.r.set(key, owner, nx=True, px=px): return True
+        with self.r.pipeline() as pipe:  # 自己持有的租約：延長期限
+            try:
+                pipe.watch(key)
+                if pipe.get(key) != owner: return False
+                pipe.multi()
+                pipe.pexpire(key, px)
+                pipe.execute()
+                return True
+            except self.redis.WatchError:
+                return False
+
+    def _release_lease(self, table_id, owner=None):
+        key = self._key('lease', table_id)
+        with self.r.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.get(key) == (owner or self.owner):
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+            except self.redis.WatchError:
+                pass  # 租約已過期並被別人接手
+
+    def state(self, table_id):
+        h = self.r.hgetall(self._key('state', table_id))
+        if not h: return None
+        return {'sync_token': h.get('sync_token') or None, 'generation': int(h['generation']), 'seq': int(h['seq']),
+                'synced_at': float(h['synced_at']), 'full_synced_at': float(h['full_synced_at'])}
+
+    def items(self, table_id):
+        items = [json.loads(v) for v in self.r.hvals(self._key('rows', table_id))]
+        return sorted(items, key=lambda i: i.get('index') or 0)
+
+    def _items_since(self, table_id, seq):
+        ids = self.r.zrangebyscore(self._key('seq', table_id), f'({seq}', '+inf')
+        if not ids: return []
+        return [json.loads(v) for v in self.r.hmget(self._key('rows', table_id), ids) if v is not None]
+
+@st.cache_resource
+def get_mirror():
+    if SHARED_CACHE_URL.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisMirror(SHARED_CACHE_URL)
+    return CodaMirror(MIRROR_PATH)
+
+# 給付條件的固定代碼表：第 k 個選項存成位元 k，位元會寫進 Parquet 快照，只能在後面新增，不可調換或刪除
+# (新增時一併調高 SnapshotStore.FORMAT)；表單與批次匯入的選項也只用這份清單
+PAYMENT_FLAGS = ('健保', '自費', '國健署專案')
+
+def split_payment(value):
+    """給付條件 (Coda 多選欄位：list 或以逗號分隔的字串) → (已知選項的位元遮罩, 其他選項以「、」串起的字串)"""
+    names = value if isinstance(value, list) else str(value or '').split(',')
+    mask, other = 0, []
+    for name in filter(None, (str(n).strip() for n in names)):
+        if name in PAYMENT_FLAGS: mask |= 1 << PAYMENT_FLAGS.index(name)
+        elif name not in other: other.append(name)
+    return mask, '、'.join(other)
+
+def payment_mask(value):
+    return split_payment(value)[0]
+
+def payment_names(mask):
+    return [name for k, name in enumerate(PAYMENT_FLAGS) if int(mask) >> k & 1]
+
+# 各表 DataFrame 的欄位型別：重複度高的字串一律存成 category (篩選、分組都只比整數代碼)，給付條件存位元遮罩 (代碼表外的選項另存一欄)
+FRAME_SCHEMAS = {
+    TABLE_ID_DRUGS: {'分類': 'category'},
+    TABLE_ID_WISHLIST: {'狀態': 'category'},
+    TABLE_ID_INVENTORY: {'診所名稱': 'category', '機構代碼': 'category', '藥品名稱': 'category', '縣市': 'category',
+                         '庫存狀態': 'category', '給付條件': 'uint8', '其他給付條件': 'category', '是否上架': 'bool'},
+    TABLE_ID_FEEDBACK: {'機構代碼': 'category', '藥品名稱': 'category', '回饋類型': 'category'},
+}
+
+def typed_frame(rows, schema):
+    df = pd.DataFrame(rows)
+    return df.astype({col: dtype for col, dtype in schema.items() if col in df.columns})
+
+def parse_drug_row(i):
+    return {'藥品名稱':i['values'].get('藥品名稱',''), '分類':i['values'].get('藥品分類','未分類'), '別名':i['values'].get('別名','')}
+
+def same_cell_value(sent, stored):
+    """送出的值與 Coda 回傳的值是否相同 (多選欄回傳以逗號分隔的字串，勾選欄回傳 bool)"""
+    if isinstance(sent, list): sent = ','.join(map(str, sent))
+    if isinstance(stored, list): stored = ','.join(map(str, stored))
+    normalize = lambda v: ''.join(str(v).split()).lower()
+    return normalize(sent) == normalize(stored if stored is not None else '')
+
+def is_notifiable_email(email):
+    """可以寄通知的真實地址：格式正確且不是 PLACEHOLDER_EMAILS 中的佔位地址"""
+    email = str(email or '').strip().lower()
+    return email not in PLACEHOLDER_EMAILS and EMAIL_PATTERN.fullmatch(email) is not None
+
+def parse_coda_time(text):
+    """Coda 的 ISO 8601 時間字串 → epoch 秒；空值或格式不對時回傳 0 (視為很久以前)"""
+    try: return datetime.fromisoformat(str(text).replace('Z', '+00:00')).timestamp()
+    except ValueError: return 0.0
+
+def parse_request_row(i):
+    return {'想要藥品':i['values'].get('想要藥品',''), '所在縣市':i['values'].get('所在縣市',''), '許願者Email':i['values'].get('許願者Email',''), '時間':parse_coda_time(i.get('createdAt'))}
+
+def parse_wishlist_row(i):
+    return {
+        '建議藥名': i['values'].get('建議藥名', ''),
+        '狀態': i['values'].get('狀態', ''),
+        '許願者Email': i['values'].get('許願者Email', '')
+    }
+
+def parse_inventory_row(i):
+    mask, other = split_payment(i['values'].get('給付條件',''))
+    return {'診所名稱':i['values'].get('診所',''), '機構代碼':i['values'].get('機構代碼',''), '藥品名稱':i['values'].get('藥品',''), '縣市':i['values'].get('縣市1', i['values'].get('縣市','')), '庫存狀態':i['values'].get('庫存狀態',''), '給付條件':mask, '其他給付條件':other, '是否上架':i['values'].get('是否上架',False), '備註':i['values'].get('備註','')}
+
+def parse_feedback_row(i):
+    return {'機構代碼':i['values'].get('機構代碼',''), '藥品名稱':i['values'].get('藥品名稱',''), '回饋類型':i['values'].get('回饋類型',''), '備註':i['values'].get('備註',''), '時間':i['values'].get('回報時間','')}
+
+class SnapshotStore:
+    """
+    已載入資料表的本機 Parquet 快照，每張表一個檔案，metadata 記錄鏡像版本與同步時間。
+    程式重啟時不必從鏡像重建 (鏡像沒資料、Coda 又連不上時也還有舊資料可看)。
+    只保存 DataFrame 與 list，其他型別 (例如計票器) 略過。
+    欄位編碼改變時 (例如給付條件的代碼表) 調高 FORMAT，舊格式的快照會被忽略、改從鏡像重建。
+    """
+    META_KEY = b'drug-finder'
+    FORMAT = 2
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, table_id):
+        return os.path.join(self.path, f"{table_id}.parquet")
+
+    def exists(self, table_id):
+        return os.path.exists(self._file(table_id))
+
+    def save(self, table_id, value, version, synced_at):
+        if isinstance(value, list):
+            frame, kind = pd.DataFrame({'value': value}), 'list'
+        elif isinstance(value, pd.DataFrame):
+            frame, kind = value, 'frame'
+        else:
+            return
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        meta = json.dumps({'format': self.FORMAT, 'kind': kind, 'version': version, 'synced_at': synced_at})
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), self.META_KEY: meta.encode()})
+        # 每次寫入用各自的暫存檔 (同一張表可能有多個執行緒 / 副本同時重建)，寫完再整檔替換，讀的人不會看到寫到一半的檔案
+        fd, tmp = tempfile.mkstemp(dir=self.path, prefix=f"{table_id}.", suffix='.tmp')
+        os.close(fd)
+        try:
+            pq.write_table(table, tmp)
+            os.replace(tmp, self._file(table_id))
+        finally:
+            if os.path.exists(tmp): os.remove(tmp)
+
+    def load(self, table_id):
+        """回傳 {'value', 'version', 'synced_at'}；沒有快照或讀不出來時回傳 None"""
+        try:
+            table = pq.read_table(self._file(table_id))
+            meta = json.loads(table.schema.metadata[self.META_KEY])
+        except (OSError, KeyError, ValueError, pa.ArrowException):
+            return None
+        if meta.get('format') != self.FORMAT: return None
+        frame = table.to_pandas()
+        value = frame['value'].tolist() if meta['kind'] == 'list' else frame
+        return {'value': value, 'version': tuple(meta['version']), 'synced_at': meta['synced_at']}
+
+class TableCache:
+    """
+    全站共用、stale-while-revalidate 的資料表快取。
+    get() 一律立即回傳手上的資料；超過 ttl、被 invalidate() 或鏡像版本已變時，在背景觸發同步，
+    每張表同時只會有一個同步在跑。只有從未載入 (且鏡像與快照都沒有資料) 的表會讓呼叫端等 Coda，
+    而且同一時間只有一個請求真的送出，其他人等它完成。
+    specs 為 {table_id: (ttl 秒, build)}，build(table_id) 從鏡像建出要提供的資料；
+    有 snapshots 時每次重建都寫一份快照，冷啟動時優先從快照提供。
+    """
+    def __init__(self, mirror, specs, snapshots=None, metrics=None):
+        self.mirror, self.specs, self.snapshots = mirror, specs, snapshots
+        self.metrics = metrics or Metrics()
+        self._lock = threading.Lock()
+        self._cold_locks = defaultdict(threading.Lock)
+        self._entries = {}      # table_id -> {'value', 'version', 'synced_at', 'data_at' (資料本身的同步時間)}
+        self._refreshing = set()
+        self._manual_at = {}
+        self.errors = {}        # table_id -> 最近一次同步失敗的例外，成功後清除
+
+    def get(self, table_id):
+        entry = self._entries.get(table_id)
+        if entry is None:
+            self.metrics.incr('table_cache', table=table_id, result='miss')
+            return self._load_cold(table_id)
+        version = self.mirror.version(table_id)
+        stale = time.time() - entry['synced_at'] > self.specs[table_id][0] or version not in (None, entry['version'])
+        self.metrics.incr('table_cache', table=table_id, result='stale' if stale else 'hit')
+        if stale:
+            self._refresh_async(table_id)
+        return entry['value']
+
+    def version(self, table_id):
+        """目前提供的資料所對應的鏡像版本，給衍生索引當快取鍵"""
+        entry = self._entries.get(table_id)
+        return entry['version'] if entry else None
+
+    def invalidate(self, table_id):
+        """讓這張表在下次 get() 時於背景重新同步 (不影響其他表)"""
+        with self._lock:
+            if table_id in self._entries: self._entries[table_id]['synced_at'] = 0
+
+    def request_refresh(self, *table_ids):
+        """使用者手動刷新：每張表 MANUAL_REFRESH_INTERVAL 秒內只接受一次，回傳是否有表被刷新"""
+        now, accepted = time.time(), False
+        for table_id in table_ids:
+            if now - self._manual_at.get(table_id, 0) < MANUAL_REFRESH_INTERVAL: continue
+            self._manual_at[table_id] = now
+            self.invalidate(table_id)
+            self._refresh_async(table_id)
+            accepted = True
+        return accepted
+
+    def peek(self, table_id):
+        """
+        與 get() 相同，但若這張表得等 Coda 才拿得到 (沒載入過、鏡像與快照也都沒有)，
+        就改在背景載入並立即回傳 None，讓呼叫端先用窄查詢應付。
+        """
+        if table_id in self._entries or self.mirror.state(table_id) or (self.snapshots and self.snapshots.exists(table_id)):
+            return self.get(table_id)
+        self._refresh_async(table_id)
+        return None
+
+    def describe(self):
+        """各已載入資料表的版本、資料時間與最近一次同步錯誤，給維運頁顯示"""
+        now = time.time()
+        return [{'table': table_id, 'version': str(entry['version']), 'age_s': round(now - entry['data_at']),
+                 'refreshing': table_id in self._refreshing, 'error': str(self.errors.get(table_id, ''))}
+                for table_id, entry in sorted(self._entries.items())]
+
+    def staleness(self, table_ids):
+        """
+        table_ids 中已載入、但資料過舊的表：{table_id: 資料的同步時間 (0 表示從未成功同步)}。
+        上次同步失敗且資料已超過 ttl，或資料比 ttl 還舊 STALE_NOTICE_AFTER 秒以上 (例如剛從舊快照啟動) 才算。
+        """
+        now, stale = time.time(), {}
+        for table_id in table_ids:
+            entry = self._entries.get(table_id)
+            if entry is None: continue
+            age, ttl = now - entry['data_at'], self.specs[table_id][0]
+            if age > ttl + STALE_NOTICE_AFTER or (table_id in self.errors and age > ttl):
+                stale[table_id] = entry['data_at']
+        return stale
+
+    def _load_cold(self, table_id):
+        with self._cold_locks[table_id]:
+            if table_id not in self._entries:
+                state = self.mirror.state(table_id)
+                version = (state['generation'], state['seq']) if state else None
+                snap = self.snapshots.load(table_id) if self.snapshots else None
+                if snap and version in (None, snap['version']):
+                    # 快照與鏡像同版就不必重建；鏡像沒資料 (例如 Coda 連不上) 時也先用快照，再到背景同步
+                    synced_at = state['synced_at'] if state else 0  # 鏡像沒資料時一律立即同步
+                    with self._lock:
+                        self._entries[table_id] = {'value': snap['value'], 'version': snap['version'], 'synced_at': synced_at, 'data_at': snap['synced_at']}
+                    if state is None: self._refresh_async(table_id)
+                elif state is None:
+                    self._refresh(table_id)  # 鏡像與快照都沒有資料，只能等 Coda
+                else:
+                    # 鏡像已有資料 (例如程式重啟)：直接提供，過期的話交給背景同步
+                    self._store(table_id, state['synced_at'])
+        return self._entries[table_id]['value']
+
+    def _refresh_async(self, table_id):
+        with self._lock:
+            if table_id in self._refreshing: return
+            self._refreshing.add(table_id)
+        threading.Thread(target=self._refresh, args=(table_id, True), name=f"refresh-{table_id}", daemon=True).start()
+
+    def _refresh(self, table_id, background=False):
+        try:
+            entry, ttl = self._entries.get(table_id), self.specs[table_id][0]
+            synced_at = entry['synced_at'] if entry else 0
+            if time.time() - synced_at > ttl:
+                try:
+                    # 鏡像可能與其他副本共用：ttl 內已有人同步過就直接用，被 invalidate() 的才強制同步
+                    with self.metrics.timer(f'sync {table_id}'):
+                        self.mirror.sync(table_id, max_age=ttl if synced_at else 0)
+                    self.errors.pop(table_id, None)
+                except Exception as e:
+                    self.errors[table_id] = e
+                state = self.mirror.state(table_id)
+                # 同步失敗或租約在別的副本手上時，REFRESH_RETRY 秒後再看一次
+                synced_at = max(state['synced_at'] if state else 0, time.time() - ttl + REFRESH_RETRY)
+            self._store(table_id, synced_at)
+        finally:
+            if background:
+                with self._lock: self._refreshing.discard(table_id)
+
+    def _store(self, table_id, synced_at):
+        entry = self._entries.get(table_id)
+        state = self.mirror.state(table_id)
+        if state is None and entry:
+            # 鏡像還沒同步成功過，手上只有快照：繼續提供快照
+            version, value, data_at = entry['version'], entry['value'], entry['data_at']
+        else:
+            version = (state['generation'], state['seq']) if state else None
+            data_at = state['synced_at'] if state else 0
+            if entry and entry['version'] == version:
+                value = entry['value']
+            else:
+                with self.metrics.timer(f'build {table_id}'):
+                    value = self.specs[table_id][1](table_id)
+                if self.snapshots and version:
+                    try:
+                        self.snapshots.save(table_id, value, version, data_at)
+                    except (OSError, pa.ArrowException):
+                        pass  # 快照只是備援，寫不進去不影響服務
+        with self._lock:
+            self._entries[table_id] = {'value': value, 'version': version, 'synced_at': synced_at, 'data_at': data_at}
+
+@st.cache_resource
+def get_table_cache():
+    mirror, vote_counter = get_mirror(), get_vote_counter()
+
+    def frame(parse_row):
+        return lambda table_id: typed_frame([parse_row(i) for i in mirror.items(table_id)], FRAME_SCHEMAS[table_id])
+
+    return TableCache(mirror, {
+        TABLE_ID_DRUGS: (60, frame(parse_drug_row)),
+        TABLE_ID_CITIES: (3600, lambda table_id: [i['name'] for i in mirror.items(table_id)]),
+        TABLE_ID_REQUESTS: (VOTE_SYNC_INTERVAL, lambda table_id: vote_counter.apply()),
+        TABLE_ID_WISHLIST: (10, frame(parse_wishlist_row)),
+        TABLE_ID_INVENTORY: (30, frame(parse_inventory_row)),
+        TABLE_ID_FEEDBACK: (5, frame(parse_feedback_row)),
+    }, SnapshotStore(SNAPSHOT_DIR) if SNAPSHOT_DIR else None, get_metrics())
+
+@instrumented
 def load_drugs_data():
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_DRUGS}/rows?useColumnNames=true'
-    try:
-        r = requests.get(url, headers=headers); r.raise_for_status(); data = r.json()
-        return pd.DataFrame([{'藥品名稱':i['values'].get('藥品名稱',''), '分類':i['values'].get('藥品分類','未分類')} for i in data['items']])
-    except: return pd.DataFrame()
+    return get_table_cache().get(TABLE_ID_DRUGS)
 
-@st.cache_data(ttl=3600)
+@instrumented
 def load_cities_data():
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_CITIES}/rows?useColumnNames=true'
-    try:
-        r = requests.get(url, headers=headers); r.raise_for_status(); data = r.json(); items = data['items']; items.sort(key=lambda x: x['index'])
-        return [i['name'] for i in items]
-    except: return []
+    return get_table_cache().get(TABLE_ID_CITIES)
 
-@st.cache_data(ttl=10)
-def load_requests_raw():
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_REQUESTS}/rows?useColumnNames=true&limit=1000'
-    try:
-        r = requests.get(url, headers=headers); r.raise_for_status(); data = r.json()
-        return pd.DataFrame([{'想要藥品':i['values'].get('想要藥品',''), '所在縣市':i['values'].get('所在縣市','')} for i in data['items']])
-    except: return pd.DataFrame()
-
-@st.cache_data(ttl=10)
+@instrumented
 def load_wishlist_data():
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_WISHLIST}/rows?useColumnNames=true&limit=100'
-    try:
-        r = requests.get(url, headers=headers)
-        r.raise_for_status()
-        data = r.json()
-        return pd.DataFrame([
-            {
-                '建議藥名': i['values'].get('建議藥名', ''),
-                '狀態': i['values'].get('狀態', ''),
-                '許願者Email': i['values'].get('許願者Email', '')
-            } 
-            for i in data['items']
-        ])
-    except:
-        return pd.DataFrame()
-
-@st.cache_data(ttl=30)
+    return get_table_cache().get(TABLE_ID_WISHLIST)
+
+@instrumented
 def load_inventory_data():
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_INVENTORY}/rows?useColumnNames=true'
-    try:
-        r = requests.get(url, headers=headers); r.raise_for_status(); data = r.json()
-        return pd.DataFrame([{'診所名稱':i['values'].get('診所',''), '機構代碼':i['values'].get('機構代碼',''), '藥品名稱':i['values'].get('藥品',''), '縣市':i['values'].get('縣市1', i['values'].get('縣市','')), '庫存狀態':i['values'].get('庫存狀態',''), '給付條件':i['values'].get('給付條件',''), '是否上架':i['values'].get('是否上架',False), '備註':i['values'].get('備註','')} for i in data['items']])
-    except: return pd.DataFrame()
+    return get_table_cache().get(TABLE_ID_INVENTORY)
 
-@st.cache_data(ttl=5) 
+@instrumented
 def load_feedback_data():
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_FEEDBACK}/rows?useColumnNames=true&limit=500'
+    return get_table_cache().get(TABLE_ID_FEEDBACK)
+
+def build_feedback_index(df):
+    """
+    把回報資料整理成 {(機構代碼, 藥品名稱): 彙總}，彙總含 ok / bad 次數、最新回報時間與已排好格式的留言。
+    每次資料更新只掃一遍，結果列表渲染時直接查表。
+    """
+    index = {}
+    if df.empty: return index
+    for code, drug, kind, note, ts in df[['機構代碼', '藥品名稱', '回饋類型', '備註', '時間']].itertuples(index=False):
+        agg = index.setdefault((code, drug), {'ok': 0, 'bad': 0, 'latest': '', 'comments': []})
+        kind = str(kind)
+        agg['ok'] += '認證' in kind
+        agg['bad'] += '不實' in kind
+        agg['latest'] = max(agg['latest'], str(ts))
+        agg['comments'].append(f"{str(ts)[:10]} {('✅' if '認證' in kind else '⚠️')} : {note}")
+    return index
+
+@st.cache_resource(max_entries=2)
+@instrumented
+def get_feedback_index(version):
+    """version 為 TableCache 中 DB_Feedback 的版本，回報有變動才重建索引"""
+    return build_feedback_index(load_feedback_data())
+
+def haversine_km(lat, lon, lats, lons):
+    """(lat, lon) 到多個點的大圓距離 (公里)，lats / lons 為 numpy 陣列"""
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 12742 * np.arcsin(np.sqrt(a))
+
+class GeoGrid:
+    """
+    經緯度點的格狀空間索引：把點放進邊長約 GEO_CELL_KM 公里的格子，
+    查詢時從所在格子一圈一圈往外找，找到的點已足夠 (或超出半徑) 就停，只算附近格子裡的點的距離。
+    mask 為 bool 陣列時只考慮 mask 為 True 的點；候選點很少時直接全部算距離。
+    """
+    BRUTE_FORCE_BELOW = 2048
+
+    def __init__(self, lats, lons):
+        self.lats, self.lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        self.cell_lat = GEO_CELL_KM / 111.32
+        self.cell_lon = GEO_CELL_KM / (111.32 * np.cos(np.radians(23.7)))  # 以台灣中部的緯度換算
+        ok = ~(np.isnan(self.lats) | np.isnan(self.lons))
+        rows, cols = np.floor(self.lats / self.cell_lat), np.floor(self.lons / self.cell_lon)
+        self.cells = {}
+        if ok.any():
+            for cell, pos in pd.Series(np.flatnonzero(ok)).groupby([rows[ok].astype(int), cols[ok].astype(int)]):
+                self.cells[cell] = pos.to_numpy()
+        self.bounds = (min(r for r, _ in self.cells), max(r for r, _ in self.cells),
+                       min(c for _, c in self.cells), max(c for _, c in self.cells)) if self.cells else None
+
+    def _ring(self, row, col, r):
+        if r == 0: return [(row, col)]
+        return ([(row + dr, col + dc) for dr in (-r, r) for dc in range(-r, r + 1)] +
+                [(row + dr, col + dc) for dc in (-r, r) for dr in range(-r + 1, r)])
+
+    def query(self, lat, lon, k=None, km=None, mask=None):
+        """距離 (lat, lon) 最近的 k 個點 (k 為 None 表示不限)，km 為半徑上限；回傳 (位置陣列, 距離陣列)，由近到遠"""
+        if mask is not None and mask.sum() < self.BRUTE_FORCE_BELOW:
+            pos = np.flatnonzero(mask)
+            pos = pos[~(np.isnan(self.lats[pos]) | np.isnan(self.lons[pos]))]
+        elif self.bounds is None:
+            pos = np.array([], dtype=int)
+        else:
+            row, col = int(np.floor(lat / self.cell_lat)), int(np.floor(lon / self.cell_lon))
+            r_max = max(row - self.bounds[0], self.bounds[1] - row, col - self.bounds[2], self.bounds[3] - col)
+            found, count = [], 0
+            for r in range(max(r_max, 0) + 1):
+                for cell in self._ring(row, col, r):
+                    hit = self.cells.get(cell)
+                    if hit is None: continue
+                    if mask is not None: hit = hit[mask[hit]]
+                    found.append(hit); count += len(hit)
+                reach = r * GEO_CELL_KM * 0.95  # 還沒看過的點至少這麼遠 (格子邊長隨緯度略有出入，打個折)
+                if km is not None and reach >= km: break
+                if k is not None and count >= k:
+                    pos = np.concatenate(found)
+                    if np.sort(haversine_km(lat, lon, self.lats[pos], self.lons[pos]))[k - 1] <= reach: break
+            pos = np.concatenate(found) if found else np.array([], dtype=int)
+        dist = haversine_km(lat, lon, self.lats[pos], self.lons[pos])
+        keep = dist <= km if km is not None else slice(None)
+        pos, dist = pos[keep], dist[keep]
+        order = np.argsort(dist, kind='stable')[:k]
+        return pos[order], dist[order]
+
+def parse_coordinates(text):
+    """「緯度, 經度」(例如從 Google 地圖複製) → (緯度, 經度)；格式不對或不在台灣附近時回傳 None"""
+    try: lat, lon = (float(v) for v in str(text).replace('，', ',').split(','))
+    except ValueError: return None
+    return (lat, lon) if 20 <= lat <= 27 and 117 <= lon <= 123 else None
+
+def normalize_city(name):
+    """縣市名稱統一寫成「臺」(DB_Cities / 庫存資料可能混用「台北市」與「臺北市」)"""
+    return str(name).strip().replace('台', '臺')
+
+@st.cache_resource(max_entries=2)
+def load_city_centroids(version):
+    """縣市 (normalize_city 過的名稱) -> (緯度, 經度)；DB_Cities 有「緯度」「經度」欄時優先使用。
+    version 為鏡像中 DB_Cities 的版本，縣市表有變動才重算"""
+    centroids = dict(CITY_CENTROIDS)
+    for i in get_mirror().items(TABLE_ID_CITIES):
+        try: centroids[normalize_city(i['name'])] = (float(i['values'].get('緯度')), float(i['values'].get('經度')))
+        except (TypeError, ValueError): pass
+    return centroids
+
+@st.cache_resource
+def load_clinic_geocodes():
+    """本機的診所座標表 (機構代碼 -> 緯度, 經度)；檔案不存在或欄位不對時為空表"""
+    empty = pd.DataFrame(columns=['緯度', '經度'], dtype='float32')
     try:
-        r = requests.get(url, headers=headers); r.raise_for_status(); data = r.json()
-        return pd.DataFrame([{'機構代碼':i['values'].get('機構代碼',''), '藥品名稱':i['values'].get('藥品名稱',''), '回饋類型':i['values'].get('回饋類型',''), '備註':i['values'].get('備註',''), '時間':i['values'].get('回報時間','')} for i in data['items']])
-    except: return pd.DataFrame()
+        df = pd.read_csv(CLINIC_GEOCODE_PATH, dtype={'機構代碼': str}, usecols=['機構代碼', '緯度', '經度'])
+    except FileNotFoundError:
+        return empty
+    except ValueError as e:  # 缺少「機構代碼」「緯度」「經度」欄
+        print(f"⚠️ 診所座標表 {CLINIC_GEOCODE_PATH} 格式不符，改以縣市中心點定位: {e}")
+        return empty
+    return df.dropna().drop_duplicates('機構代碼', keep='last').set_index('機構代碼').astype('float32')
+
+def locate_clinics(codes, cities, geocodes, centroids):
+    """回傳 (緯度, 經度, 是否為概略位置) 三個陣列；座標表查不到的診所以縣市中心點代替"""
+    geo = geocodes.reindex(pd.Index(codes.astype(str)))
+    approx = geo['緯度'].isna().to_numpy()
+    fallback = pd.Series(cities.astype(str).map(normalize_city)).map(centroids)
+    lats, lons = geo['緯度'].to_numpy(dtype='float32', copy=True), geo['經度'].to_numpy(dtype='float32', copy=True)
+    lats[approx] = [c[0] if isinstance(c, tuple) else np.nan for c in fallback[approx]]
+    lons[approx] = [c[1] if isinstance(c, tuple) else np.nan for c in fallback[approx]]
+    return lats, lons, approx
+
+class InventoryIndex:
+    """
+    找藥頁用的庫存索引，每次資料更新只建一次。
+    只保留有貨、已上架且藥名在 DB_Drugs 內的列，事先依 (藥品名稱, 縣市順序) 排好，
+    並建立 藥品 / 分類 / 縣市 → 列位置 的反向索引；篩選時以集合交集取列，排好的順序不變。
+    各列附上診所座標 (locate_clinics) 並建 GeoGrid，供「離我最近」依距離查詢。
+    """
+    def __init__(self, df_inventory, df_drugs, cities_list, geocodes=None, centroids=None):
+        if df_inventory.empty or df_drugs.empty:
+            self.frame, self.by_drug, self.by_cat, self.by_city = df_inventory, {}, {}, {}
+            self.grid = GeoGrid([], [])
+            return
+        res = df_inventory[
+            (df_inventory["庫存狀態"] == "有貨") &
+            df_inventory["是否上架"] &
+            (df_inventory["藥品名稱"].isin(df_drugs["藥品名稱"]))
+        ].copy()
+        res['縣市'] = res['縣市'].cat.set_categories(cities_list, ordered=True)
+        res['緯度'], res['經度'], res['概略位置'] = locate_clinics(
+            res['機構代碼'], res['縣市'], load_clinic_geocodes() if geocodes is None else geocodes,
+            CITY_CENTROIDS if centroids is None else centroids)
+        self.frame = res.sort_values(by=["藥品名稱", "縣市"])
+        self.grid = GeoGrid(self.frame['緯度'], self.frame['經度'])
+
+        self.by_drug = {k: set(v) for k, v in self.frame.groupby("藥品名稱", sort=False, observed=True).indices.items()}
+        self.by_city = {k: set(v) for k, v in self.frame.groupby("縣市", sort=False, observed=True).indices.items()}
+        self.by_cat = defaultdict(set)
+        for drug, cat in zip(df_drugs["藥品名稱"], df_drugs["分類"]):
+            self.by_cat[cat] |= self.by_drug.get(drug, set())
+
+    def _positions(self, drugs=None, category=None, city=None):
+        """符合條件的列位置集合；沒有任何條件時為 None"""
+        sets = []
+        if drugs is not None: sets.append(set().union(*(self.by_drug.get(d, set()) for d in drugs)))
+        if category is not None: sets.append(self.by_cat.get(category, set()))
+        if city is not None: sets.append(self.by_city.get(city, set()))
+        if not sets: return None
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def query(self, drugs=None, category=None, city=None):
+        """drugs 為藥名集合；三個條件皆為 None 表示不限，回傳符合的列 (已排序)"""
+        positions = self._positions(drugs, category, city)
+        if positions is None: return self.frame
+        return self.frame.iloc[sorted(positions)]
+
+    def nearby(self, lat, lon, km=None, k=None, drugs=None, category=None):
+        """(lat, lon) 附近 km 公里內、最近的 k 列，由近到遠，多一欄「距離」(公里)"""
+        positions = self._positions(drugs, category)
+        mask = None
+        if positions is not None:
+            mask = np.zeros(len(self.frame), dtype=bool)
+            mask[list(positions)] = True
+        pos, dist = self.grid.query(lat, lon, k=k, km=km, mask=mask)
+        return self.frame.iloc[pos].assign(距離=dist)
+
+@st.cache_resource(max_entries=2)
+@instrumented
+def get_inventory_index(version):
+    """version 為 TableCache 中 (庫存, 藥品, 縣市) 的版本，任一有變動才重建"""
+    return InventoryIndex(load_inventory_data(), load_drugs_data(), load_cities_data(), centroids=load_city_centroids(get_mirror().version(TABLE_ID_CITIES)))
+
+class InventoryQueries:
+    """
+    DB_Inventory 的窄查詢，給整張庫存表還沒到手 (冷啟動) 時的找藥頁用。
+    plan() 把條件中最有選擇性的一個 (藥品優先，其次縣市) 轉成 Coda 的 query= 參數，
+    其餘條件 (有貨、已上架、另一個欄位) 由 InventoryIndex 在本機套用；
+    Coda 的 query= 一次只能篩一個欄位，所以有貨 / 上架不下推。
+    結果依條件快取 INVENTORY_QUERY_TTL 秒，同一組條件同時只會送出一個查詢。
+    冷啟動時 Coda 最可能正在出問題：查詢失敗時改用過期的快取結果，沒有的話 index() 回傳 None，
+    找藥頁照舊顯示「資料庫讀取中」，不讓例外冒到頁面上。
+    """
+    COLUMNS = {'drug': '藥品', 'city': '縣市1'}
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._key_locks = defaultdict(threading.Lock)
+        self._results = OrderedDict()  # (欄位, 值) -> (查詢時間, frame)
+        self.last_error = None
+
+    @classmethod
+    def plan(cls, drug=None, city=None):
+        """回傳要交給 Coda 的 (欄位, 值)；沒有可下推的條件時為 None (只能讀整張表)"""
+        if drug: return cls.COLUMNS['drug'], drug
+        if city: return cls.COLUMNS['city'], city
+        return None
+
+    def fetch(self, column, value):
+        key = (column, value)
+        with self._key_locks[key]:
+            with self._lock:
+                hit = self._results.get(key)
+                if hit and time.time() - hit[0] < INVENTORY_QUERY_TTL:
+                    self._results.move_to_end(key)
+                    self.metrics.incr('inventory_query', result='hit')
+                    return hit[1]
+            self.metrics.incr('inventory_query', result='miss')
+            try:
+                with self.metrics.timer('inventory_query fetch'):
+                    items = [i for page in iter_coda_pages(TABLE_ID_INVENTORY, query=f'{json.dumps(column, ensure_ascii=False)}:{json.dumps(value, ensure_ascii=False)}')
+                             for i in page['items']]
+                    frame = typed_frame([parse_inventory_row(i) for i in items], FRAME_SCHEMAS[TABLE_ID_INVENTORY])
+            except (requests.RequestException, ValueError) as e:
+                self.metrics.incr('inventory_query', result='error')
+                self.last_error = str(e)
+                if hit: return hit[1]  # 過期的結果總比沒有好
+                raise
+            with self._lock:
+                self._results[key] = (time.time(), frame)
+                while len(self._results) > INVENTORY_QUERY_ENTRIES: self._results.popitem(last=False)
+            return frame
+
+    def index(self, df_drugs, cities_list, drug=None, city=None):
+        """只含符合條件的列的 InventoryIndex；沒有可下推的條件或向 Coda 查詢失敗時回傳 None"""
+        planned = self.plan(drug, city)
+        if planned is None: return None
+        try: frame = self.fetch(*planned)
+        except (requests.RequestException, ValueError): return None  # 已記在 metrics 與 last_error
+        return InventoryIndex(frame, df_drugs, cities_list, centroids=load_city_centroids(get_mirror().version(TABLE_ID_CITIES)))
+
+@st.cache_resource
+def get_inventory_queries():
+    return InventoryQueries(get_metrics())
+
+ZHUYIN_TONES = str.maketrans('', '', 'ˉˊˇˋ˙')
+
+def normalize_search_text(text):
+    """去空白、轉小寫並去掉注音聲調 (索引鍵與查詢字都經過這裡，帶聲調輸入的注音也能比對)"""
+    return ''.join(str(text).lower().split()).translate(ZHUYIN_TONES)
+
+def search_ngrams(text, sizes):
+    return {text[i:i + n] for n in sizes for i in range(len(text) - n + 1)} or {text}
+
+def phonetic_keys(text):
+    """拼音全拼、拼音首字母與去掉聲調的注音；沒有 pypinyin 或純英文時為空"""
+    if lazy_pinyin is None or text.isascii(): return []
+    return [''.join(lazy_pinyin(text)), ''.join(lazy_pinyin(text, style=Style.FIRST_LETTER)),
+            ''.join(lazy_pinyin(text, style=Style.BOPOMOFO)).translate(ZHUYIN_TONES)]
+
+class DrugSearchIndex:
+    """
+    DB_Drugs 的藥名搜尋索引，藥品資料有變動才重建。
+    每個藥品有多把搜尋鍵：藥名、別名 (DB_Drugs 的「別名」欄，以逗號或頓號分隔) 與拼音 / 注音，
+    全部切成 1~3 字元的 n-gram 建反向索引。
+    search() 先找「包含關鍵字」的藥品 (不當成正規表示式)，找不到時再以 n-gram 相似度
+    與同音字比對提供「您是不是要找」的建議。
+    """
+    FUZZY_THRESHOLD = 0.4
+
+    def __init__(self, df_drugs):
+        self.names, self.keys = [], []  # keys[d] = [(種類 0 藥名 / 1 別名 / 2 拼音注音, 鍵, {sizes: n-grams})]
+        self.postings = defaultdict(set)
+        aliases = df_drugs["別名"] if "別名" in df_drugs.columns else [''] * len(df_drugs)
+        seen = set()
+        for name, alias_text in zip(df_drugs["藥品名稱"], aliases):
+            if not name or name in seen: continue
+            seen.add(name)
+            alias_list = [a for a in str(alias_text or '').replace('、', ',').split(',') if a.strip()]
+            raw = [(0, name)] + [(1, a) for a in alias_list] + [(2, k) for t in [name] + alias_list for k in phonetic_keys(t)]
+            d = len(self.names)
+            self.names.append(name)
+            self.keys.append([])
+            for kind, key in raw:
+                key = normalize_search_text(key)
+                grams = {sizes: search_ngrams(key, sizes) for sizes in ((1, 2), (2, 3), (1, 2, 3))}
+                self.keys[d].append((kind, key, grams))
+                for g in grams[(1, 2, 3)]:
+                    self.postings[g].add(d)
+
+    def search(self, keyword, suggestions=5):
+        """回傳 (包含關鍵字的藥名 依相關度排序, 找不到時的相近藥名建議)"""
+        q = normalize_search_text(keyword)
+        if not q: return list(self.names), []
+        grams = search_ngrams(q, (min(len(q), 3),))
+        cands = set.intersection(*(self.postings.get(g, set()) for g in grams))
+        hits = []
+        for d in cands:
+            best = min(((kind, key.find(q)) for kind, key, _ in self.keys[d] if q in key), default=None)
+            if best is not None: hits.append((best, len(self.names[d]), d))
+        hits.sort()
+        if hits: return [self.names[d] for *_, d in hits], []
+        return [], self.suggest(q)[:suggestions]
+
+    def suggest(self, q):
+        sizes = (2, 3) if q.isascii() else (1, 2)
+        qg = search_ngrams(q, sizes)
+        scores = {}
+        for d in set().union(*(self.postings.get(g, set()) for g in qg)):
+            scores[d] = max(2 * len(qg & grams[sizes]) / (len(qg) + len(grams[sizes])) for _, _, grams in self.keys[d])
+        # 打錯同音字 (例：易力氣) 時，拼音會與正確藥名一致
+        for qp in phonetic_keys(q)[:1]:
+            for d in set.intersection(*(self.postings.get(g, set()) for g in search_ngrams(qp, (min(len(qp), 3),)))):
+                if any(kind == 2 and qp in key for kind, key, _ in self.keys[d]): scores[d] = 1.0
+        ranked = sorted((-s, d) for d, s in scores.items() if s >= self.FUZZY_THRESHOLD)
+        return [self.names[d] for _, d in ranked]
+
+@st.cache_resource(max_entries=2)
+@instrumented
+def get_drug_search_index(version):
+    """version 為 TableCache 中 DB_Drugs 的版本"""
+    return DrugSearchIndex(load_drugs_data())
+
+def load_parallel(*loaders):
+    """
+    以執行緒池同時呼叫多個 loader，依傳入順序回傳結果。
+    快取已有資料時幾乎不花時間；冷啟動時總等待時間約等於最慢的那張表，而不是全部相加。
+    """
+    ctx = get_script_run_ctx()
+
+    def run(loader):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return loader()
+
+    with ThreadPoolExecutor(max_workers=len(loaders)) as pool:
+        return list(pool.map(run, loaders))
+
+class MailSender:
+    """
+    背景寄信服務。send() 把信放進有上限的佇列後立即回傳 job id (佇列已滿時回傳 None)；
+    MAIL_WORKERS 條背景執行緒各自重複使用一條已登入的 SMTP 連線寄出，斷線就重連，
+    失敗以退避重試，閒置超過 MAIL_IDLE_CLOSE 秒才關閉連線。status(job id) 查詢寄送狀態。
+    """
+    MAX_JOBS = 5000  # 最多保留多少筆寄送狀態
+
+    def __init__(self, host, port, starttls, account, password):
+        self.host, self.port, self.starttls = host, port, starttls
+        self.account, self.password = account, password
+        self.queue = queue.Queue(maxsize=MAIL_QUEUE_SIZE)
+        self._jobs = OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        for n in range(MAIL_WORKERS):
+            threading.Thread(target=self._run, name=f"mail-sender-{n}", daemon=True).start()
+
+    def send(self, to_email, subject, body):
+        msg = MIMEText(body); msg['Subject'] = subject; msg['From'] = self.account; msg['To'] = to_email
+        job = next(self._ids)
+        self._set(job, 'queued')
+        try: self.queue.put_nowait((job, to_email, msg, 0))
+        except queue.Full:
+            self._set(job, 'failed')
+            return None
+        return job
+
+    def status(self, job):
+        """'queued' / 'sending' / 'sent' / 'failed'，查無此 job 時為 None"""
+        with self._lock:
+            return self._jobs.get(job)
+
+    def _set(self, job, state):
+        with self._lock:
+            self._jobs[job] = state
+            while len(self._jobs) > self.MAX_JOBS:
+                self._jobs.popitem(last=False)
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=MAIL_TIMEOUT)
+        if self.starttls: conn.starttls()
+        # 本機 SMTP 替身通常不支援 AUTH，此時略過登入
+        conn.ehlo_or_helo_if_needed()
+        if self.password and conn.has_extn('auth'): conn.login(self.account, self.password)
+        return conn
+
+    @staticmethod
+    def _close(conn):
+        try: conn.quit()
+        except Exception: pass
+
+    def _run(self):
+        conn = None
+        while True:
+            try:
+                job, to_email, msg, attempt = self.queue.get(timeout=MAIL_IDLE_CLOSE)
+            except queue.Empty:
+                if conn is not None: self._close(conn); conn = None
+                continue
+            self._set(job, 'sending')
+            try:
+                if conn is None: conn = self._connect()
+                conn.sendmail(self.account, to_email, msg.as_string())
+                self._set(job, 'sent')
+            except Exception as e:
+                if conn is not None: self._close(conn); conn = None
+                if isinstance(e, smtplib.SMTPRecipientsRefused) or attempt + 1 >= MAIL_MAX_ATTEMPTS:
+                    self._set(job, 'failed')
+                else:
+                    self._set(job, 'queued')
+                    threading.Timer(2 ** attempt, self.queue.put, ((job, to_email, msg, attempt + 1),)).start()
+
+@st.cache_resource
+def get_mail_sender():
+    return MailSender(SMTP_HOST, SMTP_PORT, SMTP_STARTTLS, MAIL_ACCOUNT, MAIL_PASSWORD)
 
 def send_verification_email(to_email, code):
-    msg = MIMEText(f"驗證碼：{code}"); msg['Subject']="【藥品特搜網】驗證碼"; msg['From']=MAIL_ACCOUNT; msg['To']=to_email
-    try:
-        s = smtplib.SMTP('smtp.gmail.com', 587); s.starttls(); s.login(MAIL_ACCOUNT, MAIL_PASSWORD); s.sendmail(MAIL_ACCOUNT, to_email, msg.as_string()); s.quit(); return True
-    except: return False
+    """排入寄信佇列，回傳 job id；佇列已滿時回傳 None"""
+    return get_mail_sender().send(to_email, "【藥品特搜網】驗證碼", f"驗證碼：{code}")
+
+MAIL_STATUS_TEXT = {
+    'queued': "📨 驗證碼排隊寄送中…",
+    'sending': "📨 驗證碼寄送中…",
+    'sent': "✅ 驗證碼已寄出，請查收信箱",
+    'failed': "❌ 驗證碼寄送失敗，請確認 Email 後重新寄送",
+}
+
+MAIL_PENDING_STATES = ('queued', 'sending')
+
+def render_mail_status(job):
+    """顯示驗證信的寄送狀態；還在排隊 / 寄送中時才每 2 秒輪詢，寄出或失敗後只顯示文字"""
+    state = get_mail_sender().status(job)
+    if state in MAIL_PENDING_STATES: poll_mail_status(job)
+    elif state: st.caption(MAIL_STATUS_TEXT[state])
+
+@st.fragment(run_every=2)
+def poll_mail_status(job):
+    state = get_mail_sender().status(job)
+    if state not in MAIL_PENDING_STATES:
+        st.rerun()  # 整頁重跑一次，改由 render_mail_status 畫靜態文字，這個 fragment 就不再出現、不再輪詢
+    st.caption(MAIL_STATUS_TEXT[state])
+
+class WriteQueue:
+    """
+    投票、許願與回報的背景寫入佇列 (write-behind)。
+    enqueue() 只把資料寫進本機 SQLite 的 outbox 就立即返回；背景執行緒依資料表把待寫入的列
+    合併成多列 insert，每 WRITE_FLUSH_INTERVAL 秒或累積 WRITE_BATCH_SIZE 筆時送出。
+    帶 key_columns 的列以 Coda 的 upsert (keyColumns) 送出，同一組鍵值已存在時更新該列而不是新增。
+    失敗的處理：
+      - 4xx (資料有誤)：多列的一批拆半重送，只有真正有問題的那一列標為 failed，不連累同批其他人的資料
+      - 429 或連線沒建立：確定沒寫入，以指數退避重試
+      - 5xx / 逾時 / 斷線：Coda 可能已經寫入，不盲目重送 (會重複投票)；標為 uncertain，
+        等 WRITE_VERIFY_AFTER 秒後同步鏡像核對，找到相同內容的新列就視為已送出，找不到才重送。
+        帶 key_columns 的 upsert 重送不會重複，直接重試
+    程式重啟後未送出的列也會繼續送；failed 的列保留 WRITE_FAILED_KEEP 秒供維運頁查看。
+    """
+    def __init__(self, path, client, mirror):
+        self.client, self.mirror = client, mirror
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self._wake = threading.Condition()
+        self._flush_lock = threading.Lock()  # 同時只有一個 flush，避免同一列被送兩次
+        self.last_flush_at = None
+        self.last_error = None
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, table_id TEXT, cells TEXT,
+                status TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, next_attempt_at REAL DEFAULT 0,
+                created_at REAL, sent_at REAL, row_id TEXT, last_error TEXT)""")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_status ON outbox (status, table_id)")
+            columns = [c[1] for c in self.conn.execute("PRAGMA table_info(outbox)")]
+            for column in ('key_columns', 'check_version'):  # 舊版 outbox 檔沒有這兩欄
+                if column not in columns: self.conn.execute(f"ALTER TABLE outbox ADD COLUMN {column} TEXT")
+        threading.Thread(target=self._run, name="coda-write-queue", daemon=True).start()
+
+    def enqueue(self, table_id, cells, key_columns=None):
+        """排入一列待寫入資料，回傳 outbox id"""
+        return self.enqueue_many(table_id, [cells], key_columns)[0]
+
+    def enqueue_many(self, table_id, rows, key_columns=None):
+        """
+        一次排入多列 (同一個交易)，回傳各列的 outbox id。
+        多列時立即喚醒背景執行緒，讓這一批在同一個請求中送出，不必等下一次定時 flush。
+        有 key_columns (upsert) 時每列的鍵欄都必須有值，否則 Coda 會把所有空鍵的列當成同一列互相覆蓋，丟出 ValueError。
+        """
+        if key_columns:
+            for cells in rows:
+                values = {c['column']: c['value'] for c in cells}
+                blank = [k for k in key_columns if not str(values.get(k) or '').strip()]
+                if blank: raise ValueError(f"upsert 鍵欄 {'、'.join(blank)} 不可空白")
+        keys = json.dumps(key_columns, ensure_ascii=False) if key_columns else None
+        now = time.time()
+        with self._lock, self.conn:
+            qids = [self.conn.execute("INSERT INTO outbox (table_id, cells, key_columns, created_at) VALUES (?, ?, ?, ?)",
+                                      (table_id, json.dumps(cells, ensure_ascii=False), keys, now)).lastrowid for cells in rows]
+            pending = self.conn.execute("SELECT COUNT(*) FROM outbox WHERE status = 'pending'").fetchone()[0]
+        if pending >= WRITE_BATCH_SIZE or len(rows) > 1:
+            with self._wake: self._wake.notify()
+        return qids
+
+    def _run(self):
+        while True:
+            with self._wake:
+                self._wake.wait(timeout=WRITE_FLUSH_INTERVAL)
+            try: self.flush()
+            except Exception as e: self.last_error = str(e)
+
+    def flush(self):
+        """把到期的待寫入列依資料表分批送出"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self._lock:
+            rows = self.conn.execute("""SELECT id, table_id, cells, attempts, key_columns FROM outbox
+                WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id""", (time.time(),)).fetchall()
+        by_table = defaultdict(list)  # (資料表, keyColumns) -> 列；keyColumns 是整個請求共用的，不同的要分開送
+        for row in rows:
+            by_table[row[1], row[4]].append(row[:4])
+        for (table_id, key_columns), table_rows in by_table.items():
+            for k in range(0, len(table_rows), WRITE_CHUNK_ROWS):
+                self._send(table_id, table_rows[k:k + WRITE_CHUNK_ROWS], json.loads(key_columns) if key_columns else None)
+        with self._lock:
+            uncertain = self.conn.execute("""SELECT id, table_id, cells, sent_at, check_version FROM outbox
+                WHERE status = 'uncertain' AND next_attempt_at <= ? ORDER BY id""", (time.time(),)).fetchall()
+        for table_id in dict.fromkeys(row[1] for row in uncertain):
+            self._verify(table_id, [row for row in uncertain if row[1] == table_id])
+        self.last_flush_at = time.time()
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (time.time() - 86400,))
+            self.conn.execute("DELETE FROM outbox WHERE status = 'failed' AND next_attempt_at < ?", (time.time() - WRITE_FAILED_KEEP,))
+
+    def _send(self, table_id, chunk, key_columns=None):
+        payload = {"rows": [{"cells": json.loads(cells)} for _, _, cells, _ in chunk]}
+        if key_columns: payload["keyColumns"] = key_columns
+        try:
+            r = self.client.post(table_id, payload)
+            row_ids = r.json().get('addedRowIds') or []
+        except Exception as e:
+            self.last_error = str(e)
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            if status is not None and 400 <= status < 500 and status != 429 and len(chunk) > 1:
+                # Coda 整批拒收，沒有寫入任何列：拆半重送，找出有問題的列
+                self._send(table_id, chunk[:len(chunk) // 2], key_columns)
+                self._send(table_id, chunk[len(chunk) // 2:], key_columns)
+                return
+            now = time.time()
+            if status is not None and 400 <= status < 500 and status != 429:
+                state, next_at = 'failed', now
+            elif status == 429 or isinstance(e, requests.ConnectTimeout) or key_columns:
+                state, next_at = 'pending', None
+            else:
+                state, next_at = 'uncertain', now + WRITE_VERIFY_AFTER
+            check_version = json.dumps(self.mirror.version(table_id)) if state == 'uncertain' else None
+            with self._lock, self.conn:
+                self.conn.executemany("""UPDATE outbox SET attempts = attempts + 1, status = ?, next_attempt_at = ?, last_error = ?,
+                    sent_at = ?, check_version = ? WHERE id = ?""",
+                    [(state, next_at or now + min(WRITE_MAX_BACKOFF, 2 ** attempts), str(e), now if state == 'uncertain' else None,
+                      check_version, qid) for qid, _, _, attempts in chunk])
+            return
+        if key_columns: row_ids = []  # upsert 時 addedRowIds 只含新增的列，無法依位置對回，不記 row_id
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany("UPDATE outbox SET status = 'sent', sent_at = ?, row_id = ?, last_error = NULL WHERE id = ?",
+                                  [(now, row_ids[k] if k < len(row_ids) else None, qid) for k, (qid, *_) in enumerate(chunk)])
+
+    def _verify(self, table_id, rows):
+        """
+        核對 uncertain 的列：鏡像同步到送出後 WRITE_VERIFY_AFTER 秒以後，找送出後新增、內容相同的列；
+        找到就標為 sent，找不到表示 Coda 沒寫入，改回 pending 重送。鏡像還不夠新時等下一輪。
+        """
+        attempted_at = max(row[3] or 0 for row in rows)
+        state = self.mirror.state(table_id)
+        if not state or state['synced_at'] < attempted_at + WRITE_VERIFY_AFTER:
+            self.mirror.sync(table_id, max_age=0)
+            state = self.mirror.state(table_id)
+            if not state or state['synced_at'] < attempted_at + WRITE_VERIFY_AFTER: return
+        with self._lock:
+            claimed = {r[0] for r in self.conn.execute("SELECT row_id FROM outbox WHERE table_id = ? AND row_id IS NOT NULL", (table_id,))}
+        candidates = {}
+        for check_version in dict.fromkeys(row[4] for row in rows):
+            version = json.loads(check_version) if check_version else None
+            _, items, _ = self.mirror.changes_since(table_id, tuple(version) if version else None)
+            candidates.update((i['id'], i) for i in items if i['id'] not in claimed)
+        updates = []
+        for qid, _, cells, sent_at, _ in rows:
+            cells = json.loads(cells)
+            match = next((i for i in candidates.values() if parse_coda_time(i.get('createdAt')) >= (sent_at or 0) - 300 and
+                          all(same_cell_value(c['value'], i['values'].get(c['column'])) for c in cells)), None)
+            if match: candidates.pop(match['id'])
+            updates.append(('sent', match['id'], qid) if match else ('pending', None, qid))
+        with self._lock, self.conn:
+            self.conn.executemany("UPDATE outbox SET status = ?, row_id = ?, next_attempt_at = 0 WHERE id = ?", updates)
+
+    def failed(self, limit=100):
+        """寫入失敗 (資料有誤) 的列，給維運頁查看"""
+        with self._lock:
+            rows = self.conn.execute("SELECT id, table_id, cells, created_at, last_error FROM outbox WHERE status = 'failed' ORDER BY id DESC LIMIT ?",
+                                     (limit,)).fetchall()
+        return [{'id': qid, '資料表': table_id, '內容': cells, '時間': time.strftime('%m/%d %H:%M', time.gmtime(created_at + 8 * 3600)), '錯誤': error}
+                for qid, table_id, cells, created_at, error in rows]
+
+    def clear_failed(self):
+        """維運人員確認過後清掉 failed 的列"""
+        with self._lock, self.conn:
+            return self.conn.execute("DELETE FROM outbox WHERE status = 'failed'").rowcount
+
+    def entries(self, qids):
+        """{outbox id: (status, Coda row id)}；已被清掉的 id 不會出現在結果中"""
+        qids = list(qids)
+        if not qids: return {}
+        with self._lock:
+            rows = self.conn.execute(f"SELECT id, status, row_id FROM outbox WHERE id IN ({','.join('?' * len(qids))})", qids).fetchall()
+        return {qid: (status, row_id) for qid, status, row_id in rows}
+
+    def unconfirmed(self, table_id):
+        """還沒確定寫進 Coda 的列：[(outbox id, {欄位: 值})]，用於重啟後恢復樂觀更新"""
+        with self._lock:
+            rows = self.conn.execute("SELECT id, cells FROM outbox WHERE table_id = ? AND status IN ('pending', 'uncertain')", (table_id,)).fetchall()
+        return [(qid, {c['column']: c['value'] for c in json.loads(cells)}) for qid, cells in rows]
+
+    def status(self):
+        """給 UI 顯示的佇列狀態：待送出 / 重試中 / 失敗的筆數與最近錯誤"""
+        with self._lock:
+            pending, retrying, failed = self.conn.execute("""SELECT
+                COALESCE(SUM(status = 'pending' AND attempts = 0), 0),
+                COALESCE(SUM((status = 'pending' AND attempts > 0) OR status = 'uncertain'), 0),
+                COALESCE(SUM(status = 'failed'), 0) FROM outbox""").fetchone()
+        return {'pending': pending, 'retrying': retrying, 'failed': failed,
+                'last_flush_at': self.last_flush_at, 'last_error': self.last_error}
+
+@st.cache_resource
+def get_write_queue():
+    return WriteQueue(OUTBOX_PATH, get_coda_client(), get_mirror())
+
+class TrendBuckets:
+    """
+    依建立時間分桶 (每小時一桶) 的計數，key 由呼叫端決定，例如 (藥品, 縣市)。
+    window() 只加總最近幾小時的桶；trending() 回傳每票權重隨時間以 TREND_HALF_LIFE 半衰的分數，
+    分數在 add() 時就累加好，查詢時只乘上一個共同的衰減係數。兩者都不必重掃原始資料。
+    超過 TREND_MAX_HOURS 的桶會被丟掉。
+    """
+    def __init__(self):
+        self.buckets = defaultdict(Counter)  # 小時序號 -> Counter(key -> 數量)
+        self.scores = Counter()              # key -> Σ 2^((建立時間 - epoch) / 半衰期)
+        self.epoch = time.time()
+
+    def add(self, key, ts, n=1):
+        """n 為負數時表示移除 (該列被修改或刪除)"""
+        if ts <= 0: return
+        self.buckets[int(ts // 3600)][key] += n
+        self.scores[key] += n * 2 ** ((ts - self.epoch) / TREND_HALF_LIFE)
+
+    def clear(self):
+        self.buckets.clear(); self.scores.clear()
+
+    def window(self, hours, now=None):
+        """最近 hours 小時 (含目前這一小時) 的 Counter(key -> 數量)"""
+        now_hour = int((now or time.time()) // 3600)
+        for hour in [h for h in self.buckets if h <= now_hour - TREND_MAX_HOURS]:
+            del self.buckets[hour]
+        total = Counter()
+        for hour, counts in self.buckets.items():
+            if hour > now_hour - hours: total.update(counts)
+        return +total
+
+    def trending(self, now=None):
+        """Counter(key -> 衰減後的分數)；剛投的一票約為 1"""
+        now = now or time.time()
+        if now - self.epoch > 64 * TREND_HALF_LIFE:
+            # 換新的基準時間，避免指數越來越大
+            factor = 2 ** ((self.epoch - now) / TREND_HALF_LIFE)
+            self.scores = Counter({k: v * factor for k, v in self.scores.items()})
+            self.epoch = now
+        factor = 2 ** ((self.epoch - now) / TREND_HALF_LIFE)
+        return Counter({k: v * factor for k, v in self.scores.items() if v * factor > 1e-3})
+
+class VoteCounter:
+    """
+    許願票數的常駐計數器，依藥品與 (藥品, 縣市) 累計全期票數，並依建立時間放進 TrendBuckets。
+    第一次從鏡像整批建立，之後只套用 DB_Requests 變動的列 (changes_since)；
+    本機剛送出、還在寫入佇列中的票先以樂觀方式計入，等該列出現在鏡像後再改由鏡像計算。
+    排行榜的成本只和藥品 / 縣市的組合數 (與時間桶數) 有關，與歷來總票數無關。
+    """
+    def __init__(self, mirror, write_queue):
+        self.mirror, self.write_queue = mirror, write_queue
+        self._lock = threading.Lock()
+        self.version = None
+        self.rows = {}               # Coda row id -> ((藥品, 縣市), 建立時間)
+        self.confirmed = Counter()   # (藥品, 縣市) -> 票數
+        self.trend = TrendBuckets()
+        now = time.time()  # 重啟前排隊中的票不知道確切時間，視為剛投
+        self.local = {qid: (v.get('想要藥品', ''), v.get('所在縣市', ''), now) for qid, v in write_queue.unconfirmed(TABLE_ID_REQUESTS)}
+
+    def apply(self):
+        """套用鏡像中 DB_Requests 的變動並核對樂觀票，回傳自己 (同步由 TableCache 負責)"""
+        with self._lock:
+            self.version, items, reset = self.mirror.changes_since(TABLE_ID_REQUESTS, self.version)
+            if reset:
+                self.rows.clear(); self.confirmed.clear(); self.trend.clear()
+            for i in items:
+                old = self.rows.get(i['id'])
+                if old:
+                    self.confirmed[old[0]] -= 1
+                    self.trend.add(*old, n=-1)
+                row = parse_request_row(i)
+                key = (row['想要藥品'], row['所在縣市'])
+                self.rows[i['id']] = (key, row['時間'])
+                self.confirmed[key] += 1
+                self.trend.add(key, row['時間'])
+            self._reconcile()
+        return self
 
+    def _reconcile(self):
+        entries = self.write_queue.entries(self.local)
+        for qid in list(self.local):
+            status, row_id = entries.get(qid, ('failed', None))
+            # 佇列中 → 保留；寫入失敗、已清除，或已在鏡像中看到 (或無法比對) → 交給鏡像計算
+            if status == 'failed' or (status == 'sent' and (row_id is None or row_id in self.rows)):
+                del self.local[qid]
+
+    def add_local(self, qid, drug, city):
+        with self._lock:
+            self.local[qid] = (drug, city, time.time())
+
+    def _pairs(self, window=None):
+        """
+        window 為 None 時是全期票數；TREND_WINDOWS 中的小時數則只算這段期間；
+        'trending' 為衰減後的趨勢分數。排隊中的樂觀票都是剛投的，一律計入。
+        """
+        if window is None: pairs = self.confirmed.copy()
+        elif window == 'trending': pairs = self.trend.trending()
+        else: pairs = self.trend.window(window)
+        pairs.update((drug, city) for drug, city, _ in self.local.values())
+        return +pairs
+
+    def top_drugs(self, n=None, window=None):
+        """[(藥品, 票數)]，依票數由多到少；window 同 _pairs()"""
+        with self._lock:
+            drugs = Counter()
+            for (drug, _), count in self._pairs(window).items():
+                drugs[drug] += count
+        return drugs.most_common(n)
+
+    def top_pairs(self, n=None, window=None):
+        """[(藥品, 縣市, 票數)]，依票數由多到少；window 同 _pairs()"""
+        with self._lock:
+            return [(drug, city, count) for (drug, city), count in self._pairs(window).most_common(n)]
+
+@st.cache_resource
+def get_vote_counter():
+    return VoteCounter(get_mirror(), get_write_queue())
+
+class FeedbackTrend:
+    """
+    DB_Feedback 依回報時間分桶的計數，key 為 (藥品名稱, 'ok' 或 'bad')，給熱度排行榜看近期的缺貨回報。
+    和 VoteCounter 一樣只套用鏡像中變動的列；同步由 TableCache (load_feedback_data) 負責。
+    """
+    def __init__(self, mirror):
+        self.mirror = mirror
+        self._lock = threading.Lock()
+        self.version = None
+        self.rows = {}   # Coda row id -> (key, 回報時間)
+        self.trend = TrendBuckets()
+
+    def apply(self):
+        with self._lock:
+            self.version, items, reset = self.mirror.changes_since(TABLE_ID_FEEDBACK, self.version)
+            if reset:
+                self.rows.clear(); self.trend.clear()
+            for i in items:
+                old = self.rows.get(i['id'])
+                if old: self.trend.add(*old, n=-1)
+                row = parse_feedback_row(i)
+                key = (row['藥品名稱'], 'bad' if '不實' in str(row['回饋類型']) else 'ok')
+                self.rows[i['id']] = (key, parse_coda_time(row['時間']) or parse_coda_time(i.get('createdAt')))
+                self.trend.add(*self.rows[i['id']])
+        return self
+
+    def shortage_reports(self, hours):
+        """最近 hours 小時內各藥品的「資訊不實/缺貨」回報數 [(藥品, 次數)]"""
+        with self._lock:
+            counts = self.trend.window(hours)
+        return Counter({drug: n for (drug, kind), n in counts.items() if kind == 'bad'}).most_common()
+
+@st.cache_resource
+def get_feedback_trend():
+    return FeedbackTrend(get_mirror())
+
+class RestockNotifier:
+    """
+    到貨通知的背景工作，每 RESTOCK_NOTIFY_INTERVAL 秒：
+      1. 同步鏡像中的 DB_Inventory 與 DB_Requests，只套用變動的列 (changes_since)，
+         維護每個 (藥品, 縣市) 目前有幾列「有貨且上架」，從 0 變成大於 0 的就是剛到貨
+      2. 以許願紀錄的索引 (藥品, 縣市) -> 許願者找出要通知的人；許願縣市為「全台灣」的任何縣市到貨都算
+      3. 依收件人合併成一封信，略過近期已通知過的組合，每人每天有寄信上限，超過的留待下一輪
+    有貨的組合、寄送紀錄與延後的通知存在 RESTOCK_NOTIFY_PATH，重啟後會補上停機期間到貨的組合；
+    第一次執行只記下目前狀態，不寄信。
+    這些紀錄只在本機，所以同時只能有一台主機寄通知：以共用鏡像中、擁有者為主機名稱的租約 (HOST_LEASE) 指定，
+    其他主機只待命；待命時清掉本機狀態，日後接手 (原主機停擺超過 RESTOCK_HOST_LEASE_TTL) 的第一輪只記狀態不寄信，
+    避免拿過時的紀錄重寄。同一台主機的多個副本 (共用 RESTOCK_NOTIFY_PATH) 再以一般租約確保同時只有一個在跑。
+    每輪的成本與變動的列數成正比；鏡像整表重抓 (MIRROR_FULL_RESYNC) 的那一輪才會重掃整張表。
+    """
+    LEASE = 'restock-notifier'
+    HOST_LEASE = 'restock-notifier-host'
+
+    def __init__(self, mirror, mail, metrics, path):
+        self.mirror, self.mail, self.metrics = mirror, mail, metrics
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS restock_meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS restock_available (drug TEXT, city TEXT, PRIMARY KEY (drug, city))")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS restock_sent (email TEXT, drug TEXT, city TEXT, sent_at REAL,
+                PRIMARY KEY (email, drug, city))""")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS restock_mail (email TEXT, sent_at REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS restock_mail_email ON restock_mail (email, sent_at)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS restock_pending (email TEXT, drug TEXT, city TEXT, PRIMARY KEY (email, drug, city))")
+        self.host = socket.gethostname()
+        self.inventory_version = None
+        self.stock_rows = {}          # Coda row id -> 有貨且上架時為 (藥品, 縣市)，否則 None
+        self.stock = Counter()        # (藥品, 縣市) -> 有貨且上架的列數
+        self.available = {tuple(r) for r in self.conn.execute("SELECT drug, city FROM restock_available")}
+        self.request_version = None
+        self.request_rows = {}        # Coda row id -> (Email, 藥品, 縣市)
+        self.wanted = defaultdict(Counter)  # (藥品, 縣市) -> Counter(Email -> 許願次數)
+        self.pending = defaultdict(set)     # Email -> 因寄信上限而延後的 (藥品, 縣市)
+        for email, drug, city in self.conn.execute("SELECT email, drug, city FROM restock_pending"):
+            self.pending[email].add((drug, city))
+        self.standby = False
+        self.last_run_at = None
+        self.last_error = None
+        threading.Thread(target=self._run, name="restock-notifier", daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(RESTOCK_NOTIFY_INTERVAL)
+            try:
+                if not self.mirror.acquire_lease(self.HOST_LEASE, RESTOCK_HOST_LEASE_TTL, owner=self.host):
+                    self._stand_by()
+                    continue
+                self.standby = False
+                if not self.mirror.acquire_lease(self.LEASE): continue
+            except Exception as e:
+                self.last_error = str(e)
+                continue
+            try:
+                with self.metrics.timer('restock run'):
+                    self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+            finally:
+                self.mirror.release_lease(self.LEASE)
+
+    def _stand_by(self):
+        """別台主機負責寄通知：清掉本機狀態，之後接手時第一輪只記狀態不寄信"""
+        if self.standby: return
+        self.standby = True
+        self.inventory_version = self.request_version = None
+        self.available = set()
+        self.pending.clear()
+        with self.conn:
+            self.conn.execute("DELETE FROM restock_meta WHERE key = 'initialized'")
+            self.conn.execute("DELETE FROM restock_available")
+            self.conn.execute("DELETE FROM restock_pending")
+
+    def run_once(self):
+        self.mirror.sync(TABLE_ID_INVENTORY, max_age=RESTOCK_NOTIFY_INTERVAL)
+        self.mirror.sync(TABLE_ID_REQUESTS, max_age=RESTOCK_NOTIFY_INTERVAL)
+        restocked = self._diff_inventory()
+        self._apply_requests()
+        self._notify(restocked)
+        self.last_run_at = time.time()
+
+    def _diff_inventory(self):
+        """套用庫存變動，回傳剛到貨的 (藥品, 縣市)"""
+        version, items, reset = self.mirror.changes_since(TABLE_ID_INVENTORY, self.inventory_version)
+        if version is None: return set()
+        touched = set()
+        if reset:
+            touched |= self.available
+            self.stock_rows.clear(); self.stock.clear()
+        for i in items:
+            old = self.stock_rows.get(i['id'])
+            if old: self.stock[old] -= 1; touched.add(old)
+            row = parse_inventory_row(i)
+            new = (row['藥品名稱'], row['縣市']) if row['庫存狀態'] == '有貨' and row['是否上架'] and row['藥品名稱'] else None
+            self.stock_rows[i['id']] = new
+            if new: self.stock[new] += 1; touched.add(new)
+        self.inventory_version = version
+        now_available = {p for p in touched if self.stock[p] > 0}
+        restocked, gone = now_available - self.available, (touched - now_available) & self.available
+        self.available = (self.available - gone) | restocked
+        with self.conn:
+            self.conn.executemany("DELETE FROM restock_available WHERE drug = ? AND city = ?", gone)
+            self.conn.executemany("INSERT OR IGNORE INTO restock_available VALUES (?, ?)", restocked)
+            first_run = self.conn.execute("INSERT OR IGNORE INTO restock_meta VALUES ('initialized', '1')").rowcount == 1
+        self.metrics.incr('restock_pairs', len(restocked), change='restocked')
+        return set() if first_run else restocked
+
+    def _apply_requests(self):
+        self.request_version, items, reset = self.mirror.changes_since(TABLE_ID_REQUESTS, self.request_version)
+        if reset:
+            self.request_rows.clear(); self.wanted.clear()
+        for i in items:
+            old = self.request_rows.get(i['id'])
+            if old: self.wanted[old[1:]][old[0]] -= 1
+            row = parse_request_row(i)
+            email = str(row['許願者Email']).strip().lower()
+            self.request_rows[i['id']] = new = (email, row['想要藥品'], row['所在縣市'])
+            if is_notifiable_email(email): self.wanted[new[1:]][email] += 1
+
+    def _notify(self, restocked):
+        now = time.time()
+        by_email = defaultdict(set)
+        for email, pairs in self.pending.items():
+            by_email[email] |= {p for p in pairs if self.stock[p] > 0}  # 延後期間又沒貨的就不寄了
+        self.pending.clear()
+        for drug, city in restocked:
+            for key in ((drug, city), (drug, '全台灣')):
+                for email, n in self.wanted.get(key, {}).items():
+                    if n > 0: by_email[email].add((drug, city))
+        queued = 0
+        for email, pairs in by_email.items():
+            recent = {tuple(r) for r in self.conn.execute("SELECT drug, city FROM restock_sent WHERE email = ? AND sent_at > ?",
+                                                         (email, now - RESTOCK_RENOTIFY_AFTER))}
+            pairs = sorted(pairs - recent)
+            if not pairs: continue
+            mails_today = self.conn.execute("SELECT COUNT(*) FROM restock_mail WHERE email = ? AND sent_at > ?", (email, now - 86400)).fetchone()[0]
+            if mails_today >= RESTOCK_MAILS_PER_DAY or queued >= RESTOCK_MAILS_PER_RUN or self.mail.send(email, *self._message(pairs)) is None:
+                self.pending[email].update(pairs)
+                self.metrics.incr('restock_mails', result='deferred')
+                continue
+            queued += 1
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO restock_sent VALUES (?, ?, ?, ?)", [(email, d, c, now) for d, c in pairs])
+                self.conn.execute("INSERT INTO restock_mail VALUES (?, ?)", (email, now))
+            self.metrics.incr('restock_mails', result='queued')
+        with self.conn:
+            self.conn.execute("DELETE FROM restock_mail WHERE sent_at < ?", (now - 86400,))
+            self.conn.execute("DELETE FROM restock_pending")
+            self.conn.executemany("INSERT INTO restock_pending VALUES (?, ?, ?)",
+                                  [(email, d, c) for email, pairs in self.pending.items() for d, c in pairs])
+
+    @staticmethod
+    def _message(pairs):
+        lines = "\n".join(f"・{drug}（{city}）" for drug, city in pairs)
+        link = f"\n\n立即查詢：{APP_URL}" if APP_URL else ""
+        subject = f"【藥品特搜網】您許願的{pairs[0][0]}{'等藥品' if len(pairs) > 1 else ''}有貨了"
+        return subject, f"您好，您在藥品特搜網許願的藥品已有診所回報有貨：\n\n{lines}{link}\n\n實際庫存請以診所為準，建議前往前先致電確認。"
+
+    def status(self):
+        return {'host': self.host, 'standby': self.standby, 'last_run_at': self.last_run_at, 'last_error': self.last_error,
+                'available_pairs': len(self.available),
+                'requesters': sum(len(c) for c in self.wanted.values()), 'deferred': sum(len(p) for p in self.pending.values())}
+
+@st.cache_resource
+def get_restock_notifier():
+    return RestockNotifier(get_mirror(), get_mail_sender(), get_metrics(), RESTOCK_NOTIFY_PATH)
+
+@instrumented
+def load_vote_counter():
+    return get_table_cache().get(TABLE_ID_REQUESTS)
+
+@instrumented
 def submit_wish(email, region, drug):
-    url=f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_REQUESTS}/rows'
-    payload={"rows":[{"cells":[{"column":"許願者Email","value":email},{"column":"所在縣市","value":region},{"column":"想要藥品","value":drug}]}]}
-    try: requests.post(url, headers=headers, json=payload).raise_for_status(); return True
+    cells=[{"column":"許願者Email","value":email},{"column":"所在縣市","value":region},{"column":"想要藥品","value":drug}]
+    try: get_vote_counter().add_local(get_write_queue().enqueue(TABLE_ID_REQUESTS, cells), drug, region); return True
     except: return False
 
+@instrumented
 def submit_raw_wish(email, region, new_drug_name):
     """
-    寫入 DB_Wishlist (除錯模式：會顯示詳細錯誤)
+    寫入 DB_Wishlist (排入背景寫入佇列；排入失敗時顯示詳細錯誤)
     """
     if 'TABLE_ID_WISHLIST' not in globals():
         st.error("❌ 程式碼缺少變數設定！請在最上方加入： TABLE_ID_WISHLIST = 'DB_Wishlist'")
         return False
 
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_WISHLIST}/rows'
-    
-    payload = {
-        "rows": [
-            {
-                "cells": [
-                    {"column": "許願者Email", "value": str(email)},
-                    {"column": "所在縣市", "value": str(region)},
-                    {"column": "建議藥名", "value": str(new_drug_name)},
-                    {"column": "狀態", "value": "待處理"} 
-                ]
-            }
-        ]
-    }
+    cells = [
+        {"column": "許願者Email", "value": str(email)},
+        {"column": "所在縣市", "value": str(region)},
+        {"column": "建議藥名", "value": str(new_drug_name)},
+        {"column": "狀態", "value": "待處理"} 
+    ]
     
     try:
-        r = requests.post(url, headers=headers, json=payload)
-        r.raise_for_status()
+        get_write_queue().enqueue(TABLE_ID_WISHLIST, cells)
         return True
         
     except Exception as e:
         st.error(f"❌ 寫入失敗！原因：{e}")
-        if 'r' in locals():
-            st.code(r.text, language='json')
         return False
 
+@instrumented
 def submit_supply(code, name, region, drug, conds, email):
-    url=f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_INBOX}/rows'
-    payload={"rows":[{"cells":[{"column":"機構代碼","value":code},{"column":"診所名稱","value":name},{"column":"所在縣市","value":region},{"column":"提供藥品","value":drug},{"column":"給付條件","value":conds},{"column":"聯絡Email","value":email}]}]}
-    try: requests.post(url, headers=headers, json=payload).raise_for_status(); return True
+    cells=[{"column":"機構代碼","value":code},{"column":"診所名稱","value":name},{"column":"所在縣市","value":region},{"column":"提供藥品","value":drug},{"column":"給付條件","value":conds},{"column":"聯絡Email","value":email}]
+    try: get_write_queue().enqueue(TABLE_ID_INBOX, cells, key_columns=SUPPLY_KEY_COLUMNS); return True
     except: return False
 
+def supply_conditions(df):
+    """給付條件：優先用 PAYMENT_FLAGS 同名的勾選欄，否則拆「給付條件」欄 (以逗號 / 頓號分隔)；回傳每列一個 list"""
+    flag_cols = [f for f in PAYMENT_FLAGS if f in df.columns]
+    if flag_cols:
+        flags = df[flag_cols].map(lambda v: str(v).strip().lower() in ('true', '1', 'v', 'y', 'yes', '是', '✓'))
+        return [[f for f, on in zip(flag_cols, row) if on] for row in flags.itertuples(index=False)]
+    if '給付條件' in df.columns:
+        return [[c.strip() for c in str(v).replace('、', ',').split(',') if c.strip()] if pd.notna(v) else [] for v in df['給付條件']]
+    return [[] for _ in range(len(df))]
+
+def validate_supply_rows(df, drug_names):
+    """
+    批次供貨資料的檢查：藥名須在 DB_Drugs 中、給付條件須為已知選項、同一藥品只留最後一列 (只算檢查通過的列)。
+    回傳 (可送出的 [(藥品, 條件 list)], 錯誤 DataFrame[列, 藥品, 問題])。
+    """
+    drug_col = next((c for c in SUPPLY_DRUG_COLUMNS if c in df.columns), None)
+    drugs = (df[drug_col] if drug_col else pd.Series([''] * len(df), index=df.index)).fillna('').astype(str).str.strip()
+    conds = pd.Series(supply_conditions(df), index=df.index, dtype=object)
+    problems = pd.Series('', index=df.index)
+    problems[~drugs.isin(drug_names)] = '資料庫沒有這個藥品'
+    problems[drugs == ''] = '缺少藥品名稱'
+    unknown = conds.map(lambda c: [x for x in c if x not in PAYMENT_FLAGS])
+    problems[(problems == '') & unknown.map(bool)] = '不明的給付條件：' + unknown.map('、'.join)
+    problems[(problems == '') & ~conds.map(bool)] = '請至少勾選一項給付條件'
+    valid = problems == ''  # 只在其他檢查都通過的列之間去重，免得有錯的最後一列把前面正確的列也擋掉
+    problems[valid & drugs.where(valid).duplicated(keep='last')] = '重複 (以最後一列為準)'
+    ok = problems == ''
+    errors = pd.DataFrame({'列': df.index[~ok] + 1, '藥品': drugs[~ok], '問題': problems[~ok]})
+    return list(zip(drugs[ok], conds[ok])), errors
+
+@instrumented
+def submit_supply_batch(code, name, region, rows, email):
+    """rows 為 validate_supply_rows() 檢查過的 [(藥品, 條件 list)]；整批以 (機構代碼, 提供藥品) upsert，重送時更新原列"""
+    base = [{"column":"機構代碼","value":code},{"column":"診所名稱","value":name},{"column":"所在縣市","value":region},{"column":"聯絡Email","value":email}]
+    batch = [base + [{"column":"提供藥品","value":drug},{"column":"給付條件","value":conds}] for drug, conds in rows]
+    try: get_write_queue().enqueue_many(TABLE_ID_INBOX, batch, key_columns=SUPPLY_KEY_COLUMNS); return True
+    except: return False
+
+@instrumented
 def submit_feedback(code, drug, email, type, comment):
     # 1. 檢查變數內容 (在終端機印出，方便除錯)
     print(f"準備寫入回報: 機構={code}, 藥品={drug}, Email={email}, 類型={type}")
 
-    url = f'https://coda.io/apis/v1/docs/{DOC_ID}/tables/{TABLE_ID_FEEDBACK}/rows'
-    
     # 2. 確保送出的資料格式正確
-    payload = {
-        "rows": [
-            {
-                "cells": [
-                    {"column": "機構代碼", "value": str(code)},
-                    {"column": "藥品名稱", "value": str(drug)},
-                    {"column": "回饋類型", "value": str(type)},
-                    {"column": "民眾Email", "value": str(email) if email else ""},
-                    {"column": "備註", "value": str(comment)}
-                ]
-            }
-        ]
-    }
+    cells = [
+        {"column": "機構代碼", "value": str(code)},
+        {"column": "藥品名稱", "value": str(drug)},
+        {"column": "回饋類型", "value": str(type)},
+        {"column": "民眾Email", "value": str(email) if email else ""},
+        {"column": "備註", "value": str(comment)}
+    ]
     
     try:
-        r = requests.post(url, headers=headers, json=payload)
-        r.raise_for_status() # 如果 Coda 回傳 400/500 錯誤，會跳到 except
+        get_write_queue().enqueue(TABLE_ID_FEEDBACK, cells) # 實際寫入 Coda 由背景佇列負責，失敗會自動重試
         return True
         
     except Exception as e:
         st.error(f"❌ 回報寫入失敗！")
         st.write(f"系統錯誤訊息: {e}")
-        # 這是最關鍵的：印出 Coda 告訴我們為什麼失敗
-        if 'r' in locals():
-            st.code(r.text, language='json')
         return False
 
+def render_write_queue_status():
+    """有資料還在排隊或重試時，在頁首提示使用者 (寫入失敗的列只在維運頁顯示)"""
+    q = get_write_queue().status()
+    if q['retrying']:
+        st.warning(f"⏳ 有 {q['retrying']} 筆資料暫時無法寫入，系統會自動重試。")
+    elif q['pending']:
+        st.caption(f"⏳ 有 {q['pending']} 筆資料排隊寫入中…")
+
+@st.fragment(run_every=TABLE_WAIT_POLL)
+def wait_for_table(table_id):
+    """資料表還在背景載入時顯示提示，每隔 TABLE_WAIT_POLL 秒檢查一次，到手就整頁重跑 (使用者不必自己點)"""
+    if get_table_cache().peek(table_id) is not None:
+        st.rerun()
+    st.info("資料庫讀取中，請稍候...")
+
+def render_data_freshness(table_ids):
+    """這一頁用到的資料來自舊快照或同步失敗時，在頁首說明資料的時間"""
+    table_cache = get_table_cache()
+    stale = table_cache.staleness(table_ids)
+    if not stale: return
+    oldest = min(stale.values())
+    when = time.strftime('%m/%d %H:%M', time.gmtime(oldest + 8 * 3600)) if oldest else None  # 台灣時間
+    if any(t in table_cache.errors for t in stale):
+        st.warning(f"⚠️ 暫時無法連線資料庫，目前顯示的是 {when} 的資料。" if when else "⚠️ 暫時無法連線資料庫，部分資料無法顯示。")
+    else:
+        st.info(f"🕒 目前顯示的是 {when} 的資料，正在背景更新…")
+
+ADMIN_TAB = "🛠️ 維運"
+
+def start_profiler():
+    """以 cProfile 記錄這次 rerun (只含主執行緒)；已有其他 rerun 在 profile 時回傳 None"""
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
+
+def render_profile(profiler):
+    profiler.disable()
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+    get_metrics().last_profile = out.getvalue()
+    with st.expander("⏱️ 本次 rerun 的 cProfile (依累計時間排序)"):
+        st.code(get_metrics().last_profile, language=None)
+
+def render_admin_page():
+    """維運用：各段耗時的 p50 / p99、快取命中、Coda 呼叫、背景同步與寫入狀態"""
+    metrics, table_cache = get_metrics(), get_table_cache()
+    st.markdown("### 🛠️ 維運指標")
+    st.caption(f"最近 {METRICS_WINDOW} 筆樣本的 p50 / p99 (毫秒)；網址加上 &profile=1 可 profile 單次 rerun")
+    st.dataframe(pd.DataFrame(metrics.summary()), hide_index=True, width='stretch')
+    st.markdown("#### 計數器")
+    st.dataframe(pd.DataFrame(metrics.counters()), hide_index=True, width='stretch')
+    st.markdown("#### 資料表")
+    st.dataframe(pd.DataFrame(table_cache.describe()), hide_index=True, width='stretch')
+    st.markdown("#### Coda API")
+    st.dataframe(pd.DataFrame.from_dict(get_coda_client().stats(), orient='index'), width='stretch')
+    st.markdown("#### 寫入佇列")
+    write_queue = get_write_queue()
+    st.json(write_queue.status())
+    failed = write_queue.failed()
+    if failed:
+        st.error(f"⚠️ 有 {len(failed)} 筆資料被 Coda 拒收 (資料有誤，不會再重試)，保留 {WRITE_FAILED_KEEP // 86400} 天：")
+        st.dataframe(pd.DataFrame(failed), hide_index=True, width='stretch')
+        if st.button("確認並清除失敗紀錄", key="btn_clear_failed"):
+            st.toast(f"已清除 {write_queue.clear_failed()} 筆"); st.rerun()
+    if RESTOCK_NOTIFY_INTERVAL > 0:
+        st.markdown("#### 到貨通知")
+        st.json(get_restock_notifier().status())
+    with st.expander("Prometheus 文字格式"):
+        text = metrics.prometheus()
+        st.code(text, language=None)
+        st.download_button("下載 metrics.txt", text, file_name="metrics.txt")
+    if metrics.last_profile:
+        with st.expander("上一次的 cProfile"):
+            st.code(metrics.last_profile, language=None)
+
 # ==========================================
 # 3. App 介面
 # ==========================================
 
 st.set_page_config(page_title="全台缺藥特搜網", page_icon="💊")
+
+metrics = get_metrics()
+rerun_start = time.perf_counter()
+is_admin = bool(ADMIN_TOKEN) and st.query_params.get("admin") == ADMIN_TOKEN
+profiler = start_profiler() if is_admin and st.query_params.get("profile") == "1" else None
+if RESTOCK_NOTIFY_INTERVAL > 0: get_restock_notifier()  # 第一次執行時啟動背景工作
+
 st.title("💊 全台缺藥特搜網")
+render_write_queue_status()
 
-if 'current_tab' not in st.session_state:
+TABS = ["🔍 找哪裡有藥", "📢 民眾許願", "🏥 診所回報供貨", "📊 熱度排行榜"] + ([ADMIN_TAB] if is_admin else [])
+if st.session_state.get('current_tab') not in TABS:
     st.session_state.current_tab = "🔍 找哪裡有藥"
 
 selected_tab = st.radio(
     "", 
-    ["🔍 找哪裡有藥", "📢 民眾許願", "🏥 診所回報供貨", "📊 熱度排行榜"], 
+    TABS, 
     horizontal=True,
     label_visibility="collapsed",
     key="nav_radio",
-    index=["🔍 找哪裡有藥", "📢 民眾許願", "🏥 診所回報供貨", "📊 熱度排行榜"].index(st.session_state.current_tab)
+    index=TABS.index(st.session_state.current_tab)
 )
 
 if selected_tab != st.session_state.current_tab:
     st.session_state.current_tab = selected_tab
 
-df_drugs = load_drugs_data()
-cities_list = load_cities_data()
-df_inventory = load_inventory_data()
-df_feedback = load_feedback_data()
+# 各分頁實際用到的資料表：一次平行預載，其餘分頁的表等切過去才讀
+TAB_TABLES = {
+    "🔍 找哪裡有藥": (TABLE_ID_DRUGS, TABLE_ID_CITIES, TABLE_ID_INVENTORY, TABLE_ID_FEEDBACK),
+    "📢 民眾許願": (TABLE_ID_DRUGS, TABLE_ID_CITIES, TABLE_ID_REQUESTS, TABLE_ID_WISHLIST),
+    "🏥 診所回報供貨": (TABLE_ID_DRUGS, TABLE_ID_CITIES),
+    "📊 熱度排行榜": (TABLE_ID_DRUGS, TABLE_ID_CITIES, TABLE_ID_REQUESTS, TABLE_ID_FEEDBACK),
+    ADMIN_TAB: (TABLE_ID_DRUGS, TABLE_ID_CITIES),
+}
+PUSHDOWN_TABLES = {TABLE_ID_INVENTORY}  # 冷啟動時不等整張表，先以窄查詢 (InventoryQueries) 提供
+with metrics.timer(f"tab_load {selected_tab}"):
+    table_cache = get_table_cache()
+    df_drugs, cities_list = load_parallel(*(partial(table_cache.peek if t in PUSHDOWN_TABLES else table_cache.get, t) for t in TAB_TABLES[selected_tab]))[:2]
+render_data_freshness(TAB_TABLES[selected_tab])
 
-if df_drugs.empty: st.stop()
+if df_drugs.empty:
+    st.error("暫時無法連線藥品資料庫，請稍後重新整理。")
+    st.stop()
 
 # ==========================================
 # Tab 1: 民眾許願 (最終版：支援 Relation 與 Wishlist 分流)
 # ==========================================
 if selected_tab == "📢 民眾許願":
     st.markdown("### 🎋 許願池 & 缺藥排行")
+    prep_start = time.perf_counter()
 
     # 讀取現有計票
-    df_req = load_requests_raw()
+    vote_counter = load_vote_counter()
     
     # 統計排行榜
-    if not df_req.empty and "想要藥品" in df_req.columns:
-        rank_df = df_req["想要藥品"].value_counts().reset_index()
-        rank_df.columns = ["想要藥品", "人次"]
-    else:
-        rank_df = pd.DataFrame(columns=["想要藥品", "人次"])
+    rank_df = pd.DataFrame(vote_counter.top_drugs(15), columns=["想要藥品", "人次"])
+    metrics.since(f"tab_prep {selected_tab}", prep_start)
 
     # --- 新增許願 / 推薦新藥區塊 ---
     with st.expander("➕ 找不到不在榜上的藥？點此發起新許願", expanded=False):
@@ -244,7 +2114,7 @@ if selected_tab == "📢 民眾許願":
             # 送出按鈕
             if st.form_submit_button("🚀 送出新許願", type="primary"):
                 # 處理 Email
-                final_email = u_email if u_email else "anonymous@wish"
+                final_email = u_email if u_email else ANONYMOUS_WISH_EMAIL
                 
                 # === 分流邏輯 ===
                 # 1. 民眾手動輸入新藥 -> 寫入 DB_Wishlist (待審核)
@@ -255,16 +2125,12 @@ if selected_tab == "📢 民眾許願":
                     else:
                         if submit_raw_wish(final_email, u_region, final_drug):
                             st.success(f"收到！「{final_drug}」已列入待審核清單，管理員審核後將開放票選。")
-                            time.sleep(2)
-                            st.rerun()
 
                 # 2. 民眾選擇現有藥品 -> 寫入 DB_Requests (直接計票)
                 else:
                     final_drug = u_drug_select
                     if submit_wish(final_email, u_region, final_drug):
-                        st.success(f"已記錄您的需求：{final_drug}")
-                        load_requests_raw.clear()
-                        time.sleep(1)
+                        st.toast(f"已記錄您的需求：{final_drug}")
                         st.rerun()
 
     st.divider()
@@ -289,12 +2155,9 @@ if selected_tab == "📢 民眾許願":
                         st.markdown(f"**💊 {drug_name}**")
                         if st.button(f"🙋‍♂️ 投我一票", key=f"vote_new_{idx}"):
                             default_city = "全台灣" if "全台灣" in cities_list else (cities_list[0] if cities_list else "全台灣")
-                            if submit_wish("new_arrival@vote", default_city, drug_name):
+                            if submit_wish(NEW_ARRIVAL_VOTE_EMAIL, default_city, drug_name):
                                 st.balloons()
                                 st.toast(f"已為 {drug_name} 開張第一票！")
-                                load_requests_raw.clear()
-                                time.sleep(1)
-                                st.rerun()
 
         # === 區塊 B: ⏳ 審核中 ===
         pending_drugs = df_wish[df_wish["狀態"] == "待處理"]
@@ -311,6 +2174,7 @@ if selected_tab == "📢 民眾許願":
     if rank_df.empty:
         st.info("目前還沒有人許願，搶頭香嗎？👆")
     else:
+        render_start = time.perf_counter()
         for idx, row in rank_df.head(15).iterrows():
             drug_name = row["想要藥品"]
             count = row["人次"]
@@ -324,12 +2188,11 @@ if selected_tab == "📢 民眾許願":
             with c_btn:
                 if st.button(f"🙋‍♂️ +1", key=f"plus1_{idx}_{drug_name}"):
                     default_city = "全台灣" if "全台灣" in cities_list else cities_list[0]
-                    if submit_wish("plus1@vote", default_city, drug_name):
+                    if submit_wish(PLUS_ONE_VOTE_EMAIL, default_city, drug_name):
                         st.toast(f"已為 {drug_name} +1！")
-                        load_requests_raw.clear()
-                        time.sleep(0.5)
                         st.rerun()
             st.divider()
+        metrics.since(f"tab_render {selected_tab}", render_start)
 
 # ==========================================
 # Tab 2: 診所回報
@@ -351,8 +2214,11 @@ elif selected_tab == "🏥 診所回報供貨":
                     if email_input:
                         code = str(random.randint(100000,999999))
                         st.session_state.verify_code = code; st.session_state.email_input = email_input
-                        send_verification_email(email_input, code)
-                        st.toast("已寄出")
+                        st.session_state.mail_job = send_verification_email(email_input, code)
+                        if st.session_state.mail_job: st.toast("已排入寄送")
+                        else: st.error("寄信系統忙碌中，請稍後再試")
+                if st.session_state.get("mail_job"):
+                    render_mail_status(st.session_state.mail_job)
             with c2:
                 user_code = st.text_input("驗證碼", max_chars=6)
                 if st.button("驗證"):
@@ -368,29 +2234,86 @@ elif selected_tab == "🏥 診所回報供貨":
             c_name = st.text_input("診所名稱")
             c_email = st.text_input("Email", value=st.session_state.email_input, disabled=True)
             c_region = st.selectbox("縣市", cities_list)
-            c_drug = st.selectbox("藥品", df_drugs["藥品名稱"].tolist())
-            c_conds = st.multiselect("條件", ["健保", "自費", "國健署專案"])
-            if st.button("📤 提交", type="primary"):
-                if submit_supply(c_code, c_name, c_region, c_drug, c_conds, c_email):
-                    st.success("提交成功！")
+            c_mode = st.radio("提交方式", ["單一藥品", "多項藥品 (表格 / CSV)"], horizontal=True, key="supply_mode")
+            missing = [label for label, value in (("機構代碼", c_code), ("診所名稱", c_name)) if not value.strip()]
+            if c_mode == "單一藥品":
+                c_drug = st.selectbox("藥品", df_drugs["藥品名稱"].tolist())
+                c_conds = st.multiselect("條件", PAYMENT_FLAGS)
+                if st.button("📤 提交", type="primary"):
+                    if missing:
+                        st.error(f"請先填寫{'、'.join(missing)}")
+                    elif submit_supply(c_code, c_name, c_region, c_drug, c_conds, c_email):
+                        st.success("提交成功！")
+            else:
+                st.caption(f"每列一項藥品並勾選給付條件；也可上傳 CSV (欄位：藥品、{'、'.join(PAYMENT_FLAGS)}，或以逗號分隔的「給付條件」欄)。"
+                           "同一藥品重複提交會更新原本的資料。")
+                upload = st.file_uploader("上傳 CSV", type="csv", key="supply_csv")
+                grid = pd.DataFrame({"藥品": pd.Series(dtype=str), **{f: pd.Series(dtype=bool) for f in PAYMENT_FLAGS}})
+                if upload is not None:
+                    try:
+                        uploaded = pd.read_csv(upload, dtype=str, encoding="utf-8-sig").fillna("")
+                        drug_col = next((c for c in SUPPLY_DRUG_COLUMNS if c in uploaded.columns), None)
+                        conds = supply_conditions(uploaded)
+                        grid = pd.DataFrame({"藥品": uploaded[drug_col] if drug_col else "", **{f: [f in c for c in conds] for f in PAYMENT_FLAGS}})
+                    except (ValueError, UnicodeDecodeError) as e:
+                        st.error(f"CSV 讀取失敗：{e}")
+                edited = st.data_editor(
+                    grid, num_rows="dynamic", hide_index=True, width='stretch', key=f"supply_grid_{getattr(upload, 'file_id', '')}",
+                    column_config={"藥品": st.column_config.SelectboxColumn("藥品", options=df_drugs["藥品名稱"].tolist(), required=True),
+                                   **{f: st.column_config.CheckboxColumn(f, default=False) for f in PAYMENT_FLAGS}})
+                edited = edited[edited["藥品"].fillna("").astype(str).str.strip().ne("") | edited[list(PAYMENT_FLAGS)].fillna(False).any(axis=1)]  # 略過整列空白
+                rows, errors = validate_supply_rows(edited.reset_index(drop=True), df_drugs["藥品名稱"])
+                if not errors.empty:
+                    st.warning(f"有 {len(errors)} 列需要修正，這些列不會送出：")
+                    st.dataframe(errors, hide_index=True, width='stretch')
+                if st.button(f"📤 一次提交 {len(rows)} 項藥品", type="primary", disabled=not rows or len(rows) > SUPPLY_BATCH_MAX, key="btn_supply_batch"):
+                    if missing:
+                        st.error(f"請先填寫{'、'.join(missing)}")
+                    elif submit_supply_batch(c_code, c_name, c_region, rows, c_email):
+                        st.success(f"已提交 {len(rows)} 項藥品，審核後會更新到找藥頁！")
+                if len(rows) > SUPPLY_BATCH_MAX:
+                    st.caption(f"一次最多 {SUPPLY_BATCH_MAX} 項，請分批提交。")
 
 # ==========================================
 # Tab 3: 排行榜
 # ==========================================
 elif selected_tab == "📊 熱度排行榜":
     st.markdown("### 🔥 缺藥熱度")
-    if st.button("🔄 刷新"): st.cache_data.clear(); st.rerun()
-    df_raw = load_requests_raw()
-    if not df_raw.empty:
-        df_chart = df_raw.groupby("想要藥品").size().reset_index(name="人次").sort_values("人次", ascending=False).head(10)
-        st.bar_chart(df_chart.set_index("想要藥品")["人次"])
-        st.dataframe(df_raw.groupby(["想要藥品","所在縣市"]).size().reset_index(name="人次").sort_values("人次", ascending=False), hide_index=True, width='stretch')
+    if st.button("🔄 刷新"):
+        if get_table_cache().request_refresh(TABLE_ID_REQUESTS): st.toast("已在背景更新，稍後重新整理即可看到最新票數")
+        else: st.toast("剛剛才更新過，請稍候再試")
+    period = st.radio("期間", ["🔥 趨勢", *TREND_WINDOWS, "全部"], index=2, horizontal=True, key="trend_period", label_visibility="collapsed")
+    window = {"🔥 趨勢": 'trending', "全部": None}.get(period, TREND_WINDOWS.get(period))
+    unit = "熱度" if window == 'trending' else "人次"
+    prep_start = time.perf_counter()
+    vote_counter = load_vote_counter()
+    df_chart = pd.DataFrame(vote_counter.top_drugs(10, window), columns=["想要藥品", unit])
+    df_pairs = pd.DataFrame(vote_counter.top_pairs(window=window), columns=["想要藥品", "所在縣市", unit])
+    if window == 'trending':
+        st.caption(f"每一票的權重每 {TREND_HALF_LIFE // 86400} 天減半，越近期的許願越重要")
+        df_chart[unit] = df_chart[unit].round(1); df_pairs[unit] = df_pairs[unit].round(1)
+    shortage_period = period if period in TREND_WINDOWS else "7 天"  # 趨勢 / 全部時看近 7 天
+    load_feedback_data()
+    shortages = get_feedback_trend().apply().shortage_reports(TREND_WINDOWS[shortage_period])
+    metrics.since(f"tab_prep {selected_tab}", prep_start)
+    if df_chart.empty:
+        st.info("這段期間還沒有人許願。")
+    else:
+        with metrics.timer(f"tab_render {selected_tab}"):
+            st.bar_chart(df_chart.set_index("想要藥品")[unit])
+            st.dataframe(df_pairs, hide_index=True, width='stretch')
+    if shortages:
+        st.markdown(f"#### ⚠️ 近 {shortage_period}的缺貨回報")
+        st.dataframe(pd.DataFrame(shortages[:10], columns=["藥品名稱", "回報次數"]), hide_index=True, width='stretch')
 
 # ==========================================
 # Tab 4: 找藥 (修正版：恢復回報驗證功能)
 # ==========================================
 elif selected_tab == "🔍 找哪裡有藥":
     st.markdown("### 🔍 藥品供貨清單")
+    prep_start = time.perf_counter()
+    df_inventory = get_table_cache().peek(TABLE_ID_INVENTORY)  # None 表示整張表還在背景載入
+    feedback_index = get_feedback_index(get_table_cache().version(TABLE_ID_FEEDBACK))
     
     # --- 1. 篩選區塊 ---
     with st.container(border=True):
@@ -401,20 +2324,29 @@ elif selected_tab == "🔍 找哪裡有藥":
         sel_cat = col_filter1.selectbox("📂 1. 先選分類 (選填)", unique_cats)
         
         # [B] 關鍵字搜尋
-        search_keyword = col_filter2.text_input("🔎 2. 或輸入關鍵字搜尋", placeholder="例如：易利氣")
+        search_keyword = col_filter2.text_input("🔎 2. 或輸入關鍵字搜尋", placeholder="例如：易利氣", key="search_keyword")
 
     # --- 2. 執行過濾邏輯 ---
-    filtered_drugs_df = df_drugs.copy()
+    filtered_drugs_df = df_drugs
     if sel_cat != "全部":
         filtered_drugs_df = filtered_drugs_df[filtered_drugs_df["分類"] == sel_cat]
+    suggestions = []
     if search_keyword:
-        filtered_drugs_df = filtered_drugs_df[
-            filtered_drugs_df["藥品名稱"].str.contains(search_keyword, case=False)
-        ]
+        matches, suggestions = get_drug_search_index(get_table_cache().version(TABLE_ID_DRUGS)).search(search_keyword)
+        in_cat = set(filtered_drugs_df["藥品名稱"])
+        suggestions = [n for n in suggestions if n in in_cat]
+        rank = {n: k for k, n in enumerate(matches)}
+        filtered_drugs_df = filtered_drugs_df[filtered_drugs_df["藥品名稱"].isin(rank)]
+        filtered_drugs_df = filtered_drugs_df.iloc[filtered_drugs_df["藥品名稱"].map(rank).argsort()]
 
     # --- 3. 處理搜尋結果 ---
     if filtered_drugs_df.empty:
         st.warning(f"🤔 找不到名稱包含「{search_keyword}」且分類為「{sel_cat}」的藥品...")
+        if suggestions:
+            st.markdown("💡 **您是不是要找：**")
+            sug_cols = st.columns(len(suggestions))
+            for col, name in zip(sug_cols, suggestions):
+                col.button(name, key=f"suggest_{name}", on_click=st.session_state.update, kwargs={"search_keyword": name})
         col_help1, col_help2 = st.columns([2, 1])
         with col_help1: st.markdown("👉 **資料庫還沒收錄這個藥嗎？**")
         with col_help2:
@@ -427,27 +2359,49 @@ elif selected_tab == "🔍 找哪裡有藥":
         
         st.divider()
         col_sel1, col_sel2 = st.columns(2)
-        s_drug = col_sel1.selectbox("💊 3. 選擇藥品", drug_options)
-        s_city = col_sel2.selectbox("📍 4. 選擇縣市", ["全台灣"] + cities_list)
+        if st.session_state.get("s_drug") not in drug_options:
+            st.session_state.s_drug = "全部"
+        s_drug = col_sel1.selectbox("💊 3. 選擇藥品", drug_options, key="s_drug")
+        s_city = col_sel2.selectbox("📍 4. 選擇縣市", ["全台灣", NEARBY_OPTION] + cities_list)
+
+        # 離我最近：以貼上的座標或所在縣市的中心點為原點
+        origin = None
+        if s_city == NEARBY_OPTION:
+            col_near1, col_near2, col_near3 = st.columns([1, 1, 1])
+            near_city = col_near1.selectbox("我在哪個縣市", [c for c in cities_list if c != "全台灣"], key="near_city")
+            near_text = col_near2.text_input("或貼上座標 (緯度, 經度)", placeholder="25.0330, 121.5654", key="near_coords")
+            near_km = col_near3.select_slider("範圍", NEARBY_RADII, value=10, format_func=lambda km: f"{km} 公里", key="near_km")
+            origin = parse_coordinates(near_text) if near_text else None
+            if near_text and origin is None:
+                st.warning("座標格式不對，請貼上像「25.0330, 121.5654」的緯度與經度；先以縣市中心點計算。")
+            origin = origin or load_city_centroids(get_mirror().version(TABLE_ID_CITIES)).get(normalize_city(near_city))
 
         # --- 4. 查詢庫存邏輯 ---
-        if not df_inventory.empty:
-            res = df_inventory[
-                (df_inventory["庫存狀態"] == "有貨") & 
-                (df_inventory["是否上架"] == True)
-            ].copy()
-            
-            if s_drug == "全部":
-                valid_drugs = filtered_drugs_df["藥品名稱"].tolist()
-                res = res[res["藥品名稱"].isin(valid_drugs)]
-            else:
-                res = res[res["藥品名稱"] == s_drug]
+        city = None if s_city in ("全台灣", NEARBY_OPTION) else s_city
+        if df_inventory is None:
+            # 整張庫存表還在載入：選了藥品或縣市時只向 Coda 查這一部分
+            inventory_index = get_inventory_queries().index(df_drugs, cities_list, drug=None if s_drug == "全部" else s_drug, city=city)
+        elif not df_inventory.empty:
+            table_cache = get_table_cache()
+            inventory_index = get_inventory_index(tuple(table_cache.version(t) for t in (TABLE_ID_INVENTORY, TABLE_ID_DRUGS, TABLE_ID_CITIES)))
+        else:
+            inventory_index = None
 
-            if s_city != "全台灣":
-                res = res[res["縣市"] == s_city]
-            
-            res['縣市'] = pd.Categorical(res['縣市'], categories=cities_list, ordered=True)
-            res = res.sort_values(by=["藥品名稱", "縣市"])
+        if s_city == NEARBY_OPTION and origin is None:
+            # 不退回全台列表，免得使用者以為結果已依距離排序
+            st.warning(f"找不到「{near_city}」的位置，無法依距離排序；請貼上座標 (緯度, 經度) 或改選縣市。")
+        elif inventory_index is not None:
+            if s_drug != "全部":
+                conditions = {"drugs": {s_drug}}
+            elif search_keyword:
+                conditions = {"drugs": set(filtered_drugs_df["藥品名稱"])}
+            else:
+                conditions = {"category": None if sel_cat == "全部" else sel_cat}
+            if origin is not None:
+                res = inventory_index.nearby(*origin, km=near_km, **conditions)
+            else:
+                res = inventory_index.query(city=city, **conditions)
+            metrics.since(f"tab_prep {selected_tab}", prep_start)
 
             if res.empty:
                 st.info("目前條件下尚無診所回報供貨。")
@@ -460,94 +2414,136 @@ elif selected_tab == "🔍 找哪裡有藥":
                 if 'active_feedback_id' not in st.session_state:
                     st.session_state.active_feedback_id = None
 
-                for idx, row in res.iterrows():
-                    cid = f"{row['診所名稱']}_{idx}"
-                    clinic_code = row.get('機構代碼', row['診所名稱'])
-                    drug_name = row['藥品名稱']
+                c_view, c_size = st.columns([3, 1])
+                # 選「全部」藥品時預設依藥品彙總，只送出每個藥品一張摘要卡
+                grouped = s_drug == "全部" and res["藥品名稱"].nunique() > 1 and c_view.toggle("依藥品彙總", value=True, key="group_by_drug")
+                page_size = c_size.selectbox("每頁筆數", RESULT_PAGE_SIZES, key="result_page_size", label_visibility="collapsed")
+
+                # 篩選條件或顯示方式改變時，從第一頁重新開始
+                view_key = (sel_cat, search_keyword, s_drug, s_city, origin, grouped, page_size)
+                if st.session_state.get("result_view_key") != view_key:
+                    st.session_state.result_view_key = view_key
+                    st.session_state.result_limit = page_size
+                limit = st.session_state.result_limit
+
+                render_start = time.perf_counter()
+                if grouped:
+                    summary = res.groupby("藥品名稱", sort=False, observed=True).agg(
+                        診所數=("機構代碼", "nunique"),
+                        筆數=("藥品名稱", "size"),
+                        縣市=("縣市", lambda c: "、".join(c.dropna().astype(str).unique()[:3]) + ("…" if c.nunique() > 3 else "")),
+                        **({"最近": ("距離", "min")} if "距離" in res else {}),
+                    )
+                    total = len(summary)
+                    for drug_name, g in summary.iloc[:limit].iterrows():
+                        with st.container(border=True):
+                            c_t, c_b = st.columns([4, 1])
+                            c_t.markdown(f"#### 💊 {drug_name}")
+                            c_t.caption(f"🏥 {g['診所數']} 家診所 | 📍 {g['縣市']}" + (f" | 🚶 最近約 {g['最近']:.1f} 公里" if "最近" in g else ""))
+                            c_b.button(f"查看 {g['筆數']} 筆", key=f"open_drug_{drug_name}", on_click=st.session_state.update, kwargs={"s_drug": drug_name})
+                else:
+                    total = len(res)
+                    for idx, row in res.iloc[:limit].iterrows():
+                        cid = f"{row['診所名稱']}_{idx}"
+                        clinic_code = row.get('機構代碼', row['診所名稱'])
+                        drug_name = row['藥品名稱']
                     
-                    with st.container(border=True):
-                        st.markdown(f"#### 💊 {drug_name} | 🏥 {row['診所名稱']}")
-                        conds = row['給付條件']
-                        cond_str = ' '.join([f'`{c}`' for c in (conds if isinstance(conds, list) else [conds])])
-                        st.markdown(f"📍 **{row['縣市']}** | 🏷️ {cond_str}")
-                        if row['備註']: st.info(f"備註: {row['備註']}")
-
-                        # 留言顯示
-                        if not df_feedback.empty:
-                            revs = df_feedback[(df_feedback['機構代碼']==clinic_code) & (df_feedback['藥品名稱']==drug_name)]
-                            if not revs.empty:
-                                ok = len(revs[revs['回饋類型'].str.contains("認證")])
-                                bad = len(revs[revs['回饋類型'].str.contains("不實")])
-                                st.markdown(f"✅ **{ok}**　⚠️ **{bad}**")
-                                with st.expander(f"查看 {len(revs)} 則留言"):
-                                    for _, r in revs.iterrows():
-                                        st.text(f"{str(r['時間'])[:10]} {('✅' if '認證' in str(r['回饋類型']) else '⚠️')} : {r['備註']}")
-
-                        # 回報按鈕
-                        if st.session_state.active_feedback_id != cid:
-                            if st.button("💬 我要回報/認證", key=f"btn_open_{cid}"):
-                                st.session_state.active_feedback_id = cid
-                                st.rerun()
+                        with st.container(border=True):
+                            st.markdown(f"#### 💊 {drug_name} | 🏥 {row['診所名稱']}")
+                            cond_str = ' '.join([f'`{c}`' for c in payment_names(row['給付條件']) + [o for o in str(row.get('其他給付條件') or '').split('、') if o]])
+                            distance = f" | 🚶 {'約 ' if row['概略位置'] else ''}{row['距離']:.1f} 公里" if "距離" in row else ""
+                            st.markdown(f"📍 **{row['縣市']}**{distance} | 🏷️ {cond_str}")
+                            if row['備註']: st.info(f"備註: {row['備註']}")
+
+                            # 留言顯示
+                            revs = feedback_index.get((clinic_code, drug_name))
+                            if revs:
+                                st.markdown(f"✅ **{revs['ok']}**　⚠️ **{revs['bad']}**")
+                                with st.expander(f"查看 {len(revs['comments'])} 則留言"):
+                                    for line in revs['comments']:
+                                        st.text(line)
+
+                            # 回報按鈕
+                            if st.session_state.active_feedback_id != cid:
+                                if st.button("💬 我要回報/認證", key=f"btn_open_{cid}"):
+                                    st.session_state.active_feedback_id = cid
+                                    st.rerun()
                         
-                        # [填寫回報區塊] - 已修復
-                        if st.session_state.active_feedback_id == cid:
-                            st.markdown("---")
-                            st.markdown("##### 📝 填寫回報 (需驗證 Email 以防惡意洗版)")
+                            # [填寫回報區塊] - 已修復
+                            if st.session_state.active_feedback_id == cid:
+                                st.markdown("---")
+                                st.markdown("##### 📝 填寫回報 (需驗證 Email 以防惡意洗版)")
                             
-                            v_key = f"verified_{cid}"
-                            if v_key not in st.session_state: 
-                                st.session_state[v_key] = False
+                                v_key = f"verified_{cid}"
+                                if v_key not in st.session_state: 
+                                    st.session_state[v_key] = False
                             
-                            # A: 尚未驗證
-                            if not st.session_state[v_key]:
-                                with st.container(border=True):
-                                    col_f1, col_f2 = st.columns([1, 1])
-                                    umail = col_f1.text_input("您的 Email", key=f"mail_{cid}")
-                                    if col_f1.button("寄送驗證碼", key=f"send_{cid}"):
-                                        if umail:
-                                            code = str(random.randint(100000, 999999))
-                                            st.session_state[f"code_{cid}"] = code
-                                            if send_verification_email(umail, code):
-                                                st.toast(f"驗證碼已寄至 {umail}")
+                                # A: 尚未驗證
+                                if not st.session_state[v_key]:
+                                    with st.container(border=True):
+                                        col_f1, col_f2 = st.columns([1, 1])
+                                        umail = col_f1.text_input("您的 Email", key=f"mail_{cid}")
+                                        if col_f1.button("寄送驗證碼", key=f"send_{cid}"):
+                                            if umail:
+                                                code = str(random.randint(100000, 999999))
+                                                st.session_state[f"code_{cid}"] = code
+                                                st.session_state[f"mail_job_{cid}"] = send_verification_email(umail, code)
+                                                if st.session_state[f"mail_job_{cid}"]:
+                                                    st.toast(f"驗證碼將寄至 {umail}")
+                                                else:
+                                                    st.error("寄信系統忙碌中，請稍後再試")
                                             else:
-                                                st.error("寄送失敗，請檢查 Email 格式")
-                                        else:
-                                            st.warning("請輸入 Email")
+                                                st.warning("請輸入 Email")
+                                        if st.session_state.get(f"mail_job_{cid}"):
+                                            with col_f1: render_mail_status(st.session_state[f"mail_job_{cid}"])
                                     
-                                    ucode = col_f2.text_input("輸入驗證碼", max_chars=6, key=f"code_in_{cid}")
-                                    if col_f2.button("驗證身分", key=f"verify_{cid}"):
-                                        saved_code = st.session_state.get(f"code_{cid}")
-                                        if ucode and saved_code and ucode == saved_code:
-                                            st.session_state[v_key] = True
-                                            st.success("驗證成功！請填寫下方內容")
-                                            time.sleep(0.5)
-                                            st.rerun()
-                                        else:
-                                            st.error("驗證碼錯誤或過期")
-
-                            # B: 已驗證 -> 顯示表單
-                            else:
-                                with st.form(key=f"feedback_form_{cid}"):
-                                    st.caption(f"由 {st.session_state.get(f'mail_{cid}')} 回報")
-                                    fb_type = st.radio("回報類型", ["✅ 認證有貨", "⚠️ 資訊不實/缺貨"], key=f"type_{cid}")
-                                    cmmt = st.text_area("詳細說明", key=f"cmmt_{cid}")
+                                        ucode = col_f2.text_input("輸入驗證碼", max_chars=6, key=f"code_in_{cid}")
+                                        if col_f2.button("驗證身分", key=f"verify_{cid}"):
+                                            saved_code = st.session_state.get(f"code_{cid}")
+                                            if ucode and saved_code and ucode == saved_code:
+                                                st.session_state[v_key] = True
+                                                st.success("驗證成功！請填寫下方內容")
+                                                time.sleep(0.5)
+                                                st.rerun()
+                                            else:
+                                                st.error("驗證碼錯誤或過期")
+
+                                # B: 已驗證 -> 顯示表單
+                                else:
+                                    with st.form(key=f"feedback_form_{cid}"):
+                                        st.caption(f"由 {st.session_state.get(f'mail_{cid}')} 回報")
+                                        fb_type = st.radio("回報類型", ["✅ 認證有貨", "⚠️ 資訊不實/缺貨"], key=f"type_{cid}")
+                                        cmmt = st.text_area("詳細說明", key=f"cmmt_{cid}")
                                     
-                                    col_b1, col_b2 = st.columns([1, 4])
-                                    submitted = col_b1.form_submit_button("📤 送出回報", type="primary")
-                                    cancelled = col_b2.form_submit_button("取消")
+                                        col_b1, col_b2 = st.columns([1, 4])
+                                        submitted = col_b1.form_submit_button("📤 送出回報", type="primary")
+                                        cancelled = col_b2.form_submit_button("取消")
                                 
-                                if submitted:
-                                    user_mail = st.session_state.get(f"mail_{cid}")
-                                    if submit_feedback(clinic_code, drug_name, user_mail, fb_type, cmmt):
-                                        st.success("感謝您的回報！")
+                                    if submitted:
+                                        user_mail = st.session_state.get(f"mail_{cid}")
+                                        if submit_feedback(clinic_code, drug_name, user_mail, fb_type, cmmt):
+                                            st.toast("感謝您的回報！")
+                                            st.session_state.active_feedback_id = None
+                                            st.rerun()
+
+                                    if cancelled:
                                         st.session_state.active_feedback_id = None
-                                        load_feedback_data.clear()
-                                        time.sleep(1)
                                         st.rerun()
 
-                                if cancelled:
-                                    st.session_state.active_feedback_id = None
-                                    st.rerun()
+                if total > limit:
+                    st.button(f"⬇️ 載入更多（還有 {total - limit} 筆）", key="btn_load_more", on_click=st.session_state.update, kwargs={"result_limit": limit + page_size})
+                metrics.since(f"tab_render {selected_tab}", render_start)
+        elif df_inventory is None:
+            wait_for_table(TABLE_ID_INVENTORY)  # 冷啟動、又沒有可下推的條件 (或窄查詢失敗)
         else:
              st.info("資料庫讀取中，請稍候...")
 
+# ==========================================
+# 維運頁 (僅 ?admin=<ADMIN_TOKEN> 時出現)
+# ==========================================
+elif selected_tab == ADMIN_TAB:
+    render_admin_page()
+
+metrics.since(f"rerun {selected_tab}", rerun_start)
+if profiler:
+    render_profile(profiler)
@@ -0,0 +1,210 @@
+"""
+app4.py 的端對端效能測試：啟動 fake_coda.py 假資料伺服器，量測
+  1. 各資料表的載入：冷啟動 (向 Coda 同步 + 建表)、從鏡像重建、增量同步的時間與 DataFrame 記憶體
+  2. 各分頁的 rerun：透過 Streamlit AppTest 實際執行 app4.py，記錄每次 rerun 的延遲、
+     期間打到 Coda 的請求數，以及單次 rerun 的 Python 記憶體峰值 (tracemalloc)
+
+  python bench.py --inventory 100000 --votes 1000000 --runs 10 --json bench.json
+  python bench.py --baseline bench.json      # 與上次結果比較，變慢超過 --threshold 時以非 0 結束
+
+全部在暫存目錄中進行，不會用到真的 Coda 文件、也不會寄出任何信件。
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")  # 只看結果，不看 AppTest 執行時的警告
+from streamlit.testing.v1 import AppTest
+
+from fake_coda import FakeCoda
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app4.py")
+TABLES = ["DB_Drugs", "DB_Cities", "DB_Inventory", "DB_Feedback", "DB_Requests", "DB_Wishlist"]
+
+
+def scenario(tab, **widgets):
+    """切到 tab 後依序設定 widgets (key -> 值)；AppTest 找不到該元件時略過"""
+    def apply(at):
+        at.radio(key="nav_radio").set_value(tab)
+        for key, value in widgets.items():
+            for kind in ("text_input", "toggle", "selectbox"):
+                try:
+                    getattr(at, kind)(key=key).set_value(value)
+                    break
+                except KeyError:
+                    continue
+    return apply
+
+
+SCENARIOS = {
+    "🔍 找藥 (依藥品彙總)": scenario("🔍 找哪裡有藥"),
+    "🔍 找藥 (逐筆明細)": scenario("🔍 找哪裡有藥", group_by_drug=False),
+    "🔍 關鍵字搜尋": scenario("🔍 找哪裡有藥", search_keyword="易利"),
+    "📢 民眾許願": scenario("📢 民眾許願"),
+    "🏥 診所回報供貨": scenario("🏥 診所回報供貨"),
+    "📊 熱度排行榜": scenario("📊 熱度排行榜"),
+}
+
+
+def make_secrets(base, workdir, name):
+    return {
+        "CODA_API_KEY": "bench", "DOC_ID": "bench", "MAIL_ACCOUNT": "bench@example.com", "MAIL_PASSWORD": "bench",
+        "CODA_API_BASE": base, "SMTP_HOST": "127.0.0.1", "SMTP_PORT": 9, "SMTP_STARTTLS": False,
+        "MIRROR_PATH": os.path.join(workdir, f"{name}_mirror.sqlite3"),
+        "OUTBOX_PATH": os.path.join(workdir, f"{name}_outbox.sqlite3"),
+        "SNAPSHOT_DIR": os.path.join(workdir, f"{name}_snapshots"),
+        "RESTOCK_NOTIFY_PATH": os.path.join(workdir, f"{name}_restock.sqlite3"),
+        "RESTOCK_NOTIFY_INTERVAL": 0,  # 量測時不跑到貨通知
+    }
+
+
+def load_app_core(secrets, workdir):
+    """只執行 app4.py 的設定區與核心函式 (不畫介面)，回傳模組；secrets 寫進 workdir/.streamlit/secrets.toml"""
+    os.makedirs(os.path.join(workdir, ".streamlit"), exist_ok=True)
+    with open(os.path.join(workdir, ".streamlit", "secrets.toml"), "w", encoding="utf-8") as f:
+        f.writelines(f"{k} = {json.dumps(v)}\n" for k, v in secrets.items())
+    with open(APP_PATH, encoding="utf-8") as f:
+        src = f.read().split("# 3. App 介面")[0]
+    module = types.ModuleType("app4_core")
+    module.__file__ = APP_PATH
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        exec(compile(src, APP_PATH, "exec"), module.__dict__)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+def frame_bytes(value):
+    if hasattr(value, "memory_usage"):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, list):
+        return sum(sys.getsizeof(v) for v in value) + sys.getsizeof(value)
+    return None
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def bench_loaders(fake, base, workdir, runs):
+    app = load_app_core(make_secrets(base, workdir, "loaders"), workdir)
+    cache, mirror = app.get_table_cache(), app.get_mirror()
+    results = {}
+    for table_id in TABLES:
+        calls = fake.requests["GET"]
+        cold_ms, value = timed(cache.get, table_id)
+        build = cache.specs[table_id][1]
+        build_ms = statistics.median(timed(build, table_id)[0] for _ in range(runs))
+        first = fake.table(table_id).seed_row(0)["values"]
+        fake.add(table_id, first, keys=list(first)[:1])  # 改寫第一列 (內容不變、updatedAt 更新)，量一次增量同步
+        delta_ms, _ = timed(mirror.sync, table_id)
+        results[table_id] = {"rows": len(mirror.items(table_id)), "cold_ms": cold_ms, "build_ms": build_ms,
+                             "delta_sync_ms": delta_ms, "coda_gets": fake.requests["GET"] - calls, "bytes": frame_bytes(value)}
+    return results
+
+
+def bench_tabs(fake, base, workdir, runs):
+    at = AppTest.from_file(APP_PATH, default_timeout=600)
+    for k, v in make_secrets(base, workdir, "tabs").items():
+        at.secrets[k] = v
+    cold_ms, _ = timed(at.run)
+    if at.exception:
+        raise RuntimeError(at.exception[0].value)
+    results = {"_cold_start": {"p50_ms": cold_ms}}
+    for name, apply in SCENARIOS.items():
+        apply(at)
+        at.run()  # 切換分頁本身那次不計，之後才是同一頁的一般 rerun
+        if at.exception:
+            raise RuntimeError(f"{name}: {at.exception[0].value}")
+        calls = sum(fake.requests.values())
+        samples = []
+        for _ in range(runs):
+            apply(at)
+            samples.append(timed(at.run)[0])
+        tracemalloc.start()
+        apply(at)
+        at.run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        samples.sort()
+        results[name] = {"p50_ms": statistics.median(samples), "max_ms": samples[-1],
+                         "coda_calls": sum(fake.requests.values()) - calls, "peak_bytes": peak}
+    return results
+
+
+def compare(current, baseline, threshold):
+    """回傳變慢的項目 [(名稱, 指標, 舊值, 新值)]；差距小於 5ms 的雜訊不算"""
+    slower = []
+    for section in ("loaders", "tabs"):
+        for name, metrics in current.get(section, {}).items():
+            old = baseline.get(section, {}).get(name, {})
+            for metric, value in metrics.items():
+                if not metric.endswith("_ms") or metric not in old: continue
+                if value > old[metric] * (1 + threshold) and value - old[metric] > 5:
+                    slower.append((name, metric, old[metric], value))
+    return slower
+
+
+def fmt_bytes(n):
+    return "-" if n is None else f"{n / 1e6:.1f} MB"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="app4.py 端對端效能測試")
+    parser.add_argument("--drugs", type=int, default=50)
+    parser.add_argument("--inventory", type=int, default=20000)
+    parser.add_argument("--votes", type=int, default=100000)
+    parser.add_argument("--feedback", type=int, default=20000)
+    parser.add_argument("--clinics", type=int, default=3000)
+    parser.add_argument("--latency", type=float, default=0.05, help="fake Coda 每個請求的延遲 (秒)")
+    parser.add_argument("--rate", type=int, default=0, help="fake Coda 每秒請求上限 (0 表示不限)")
+    parser.add_argument("--runs", type=int, default=5, help="每個情境量測幾次 rerun")
+    parser.add_argument("--json", help="把結果寫成 JSON 檔")
+    parser.add_argument("--baseline", help="與先前 --json 存下的結果比較")
+    parser.add_argument("--threshold", type=float, default=0.2, help="比 baseline 慢多少比例算退步")
+    args = parser.parse_args()
+
+    fake = FakeCoda(args.drugs, args.inventory, args.votes, args.feedback, args.clinics, args.latency, args.rate)
+    server, base = fake.serve()
+    workdir = tempfile.mkdtemp(prefix="drug-finder-bench-")
+    try:
+        results = {"config": {k: v for k, v in vars(args).items() if k not in ("json", "baseline")},
+                   "loaders": bench_loaders(fake, base, workdir, args.runs),
+                   "tabs": bench_tabs(fake, base, workdir, args.runs)}
+    finally:
+        server.shutdown()
+
+    print(f"\n{'資料表':<16}{'列數':>9}{'冷啟動':>11}{'重建':>10}{'增量同步':>10}{'Coda GET':>10}{'記憶體':>10}")
+    for name, r in results["loaders"].items():
+        print(f"{name:<16}{r['rows']:>9}{r['cold_ms']:>9.0f}ms{r['build_ms']:>8.1f}ms{r['delta_sync_ms']:>8.1f}ms{r['coda_gets']:>10}{fmt_bytes(r['bytes']):>10}")
+    print(f"\n{'情境':<20}{'p50':>10}{'max':>10}{'Coda 請求':>10}{'記憶體峰值':>12}")
+    for name, r in results["tabs"].items():
+        if name == "_cold_start":
+            print(f"{'(第一次載入)':<20}{r['p50_ms']:>8.0f}ms")
+            continue
+        print(f"{name:<20}{r['p50_ms']:>8.1f}ms{r['max_ms']:>8.1f}ms{r['coda_calls']:>10}{fmt_bytes(r['peak_bytes']):>12}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            slower = compare(results, json.load(f), args.threshold)
+        for name, metric, old, new in slower:
+            print(f"⚠️ {name} {metric}: {old:.1f} → {new:.1f}")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""
+本機的 Coda rows API 替身，給效能測試與離線開發用 (不需要網路，也不會動到真的 Coda 文件)。
+
+支援 app4.py 用到的部分：
+  GET  /docs/{doc}/tables/{table}/rows   分頁 (limit / pageToken)、syncToken 增量、query="欄位":值 篩選
+  POST /docs/{doc}/tables/{table}/rows   多列新增與 keyColumns upsert，回傳 addedRowIds
+另外可注入固定延遲與每秒請求上限 (超過時回 429 + Retry-After)。
+
+種子資料依列號以亂數「按需產生」，同一列每次產生的內容都相同，
+所以百萬列的表不必先放進記憶體；只有新增或修改過的列才另外存起來。
+
+單獨啟動 (再把 secrets 的 CODA_API_BASE 設成 http://127.0.0.1:8765)：
+  python fake_coda.py --port 8765 --inventory 100000 --votes 1000000 --latency 0.2 --rate 10
+"""
+import argparse
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+CITIES = ["臺北市", "新北市", "桃園市", "臺中市", "臺南市", "高雄市", "基隆市", "新竹市", "嘉義市", "新竹縣", "苗栗縣",
+          "彰化縣", "南投縣", "雲林縣", "嘉義縣", "屏東縣", "宜蘭縣", "花蓮縣", "臺東縣", "澎湖縣", "金門縣", "連江縣"]
+DRUGS = [("易利氣", "呼吸道"), ("克流感", "抗病毒"), ("安莫西林", "抗生素"), ("普拿疼", "止痛退燒"), ("希克勞", "抗生素"),
+         ("欣流", "呼吸道"), ("氣舒痰", "呼吸道"), ("胃乳片", "腸胃"), ("利福平", "抗生素"), ("樂爾舒", "腸胃")]
+CATEGORIES = ["呼吸道", "抗病毒", "抗生素", "止痛退燒", "腸胃", "心血管", "皮膚", "眼科"]
+PAYMENTS = ["健保", "自費", "國健署專案"]
+FEEDBACK_KINDS = ["✅ 認證有貨", "⚠️ 資訊不實/缺貨"]
+
+
+def now_iso():
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime())
+
+
+class FakeTable:
+    """
+    一張假資料表：前 count 列由 make(k, rnd) 產生，seq 為 k + 1；之後新增或修改的列放在 rows，
+    seq 由 clock 接續遞增。syncToken 就是當時的 seq 上限。
+    """
+    def __init__(self, name, count=0, make=None):
+        self.name, self.count, self.make = name, count, make
+        self.clock = itertools.count(count + 1)
+        self.rows = {}        # row_id -> 新增或修改過的列
+        self.ids = itertools.count(count)
+
+    def seed_row(self, k):
+        values = self.make(k, random.Random(k * 1000003 + len(self.name)))
+        return {"id": f"i-{k}", "type": "row", "index": k, "name": str(next(iter(values.values()), "")),
+                "createdAt": "2026-01-01T00:00:00.000Z", "updatedAt": "2026-01-01T00:00:00.000Z",
+                "values": values, "_seq": k + 1}
+
+    def horizon(self):
+        return max([self.count] + [r["_seq"] for r in self.rows.values()])
+
+    def scan(self, since, horizon, cursor):
+        """從 cursor (種子列號, 已略過的額外列數) 開始，依 seq 順序產生 since < seq <= horizon 的列與下一個 cursor"""
+        k, extra = cursor
+        for k in range(max(k, since), min(self.count, horizon)):
+            if f"i-{k}" not in self.rows:
+                yield self.seed_row(k), (k + 1, 0)
+        extras = sorted((r for r in self.rows.values() if since < r["_seq"] <= horizon), key=lambda r: r["_seq"])
+        for n, row in enumerate(extras[extra:], extra + 1):
+            yield row, (self.count, n)
+
+    def find(self, keys, values):
+        for k in range(self.count):
+            row = self.rows.get(f"i-{k}") or self.seed_row(k)
+            if all(row["values"].get(c) == values.get(c) for c in keys):
+                return row
+        return next((r for r in self.rows.values() if all(r["values"].get(c) == values.get(c) for c in keys)), None)
+
+    def upsert(self, values, keys=()):
+        """回傳新增列的 id；keyColumns 對到既有的列時改為更新並回傳 None"""
+        hit = self.find(keys, values) if keys else None
+        if hit:
+            row = dict(hit, values={**hit["values"], **values}, updatedAt=now_iso(), _seq=next(self.clock))
+            self.rows[row["id"]] = row
+            return None
+        k = next(self.ids)
+        self.rows[f"i-{k}"] = {"id": f"i-{k}", "type": "row", "index": k, "name": str(next(iter(values.values()), "")),
+                               "createdAt": now_iso(), "updatedAt": now_iso(), "values": values, "_seq": next(self.clock)}
+        return f"i-{k}"
+
+
+class FakeCoda:
+    """
+    以合成資料建立 app4.py 用到的各張表，並提供 HTTP 伺服器。
+    latency 為每個請求的固定延遲 (秒)，rate 為每秒請求上限 (0 表示不限)。
+    """
+    def __init__(self, drugs=len(DRUGS), inventory=200, votes=500, feedback=200, clinics=300, latency=0.0, rate=0):
+        self.latency, self.rate = latency, rate
+        self.lock = threading.Lock()
+        self.hits = []
+        self.requests = {"GET": 0, "POST": 0, "429": 0}
+        drug_names = [DRUGS[k] if k < len(DRUGS) else (f"測試藥{k:05d}", CATEGORIES[k % len(CATEGORIES)]) for k in range(drugs)]
+
+        def pick_drug(rnd):
+            return drug_names[min(int(rnd.paretovariate(1.2)) - 1, drugs - 1)][0]  # 少數熱門藥占多數
+
+        self.tables = {t.name: t for t in [
+            FakeTable("DB_Drugs", drugs, lambda k, rnd: {"藥品名稱": drug_names[k][0], "藥品分類": drug_names[k][1], "別名": ""}),
+            FakeTable("DB_Cities", len(CITIES), lambda k, rnd: {"縣市": CITIES[k]}),
+            FakeTable("DB_Inventory", inventory, lambda k, rnd: {
+                "診所": f"診所{k % clinics:05d}", "機構代碼": str(3500000000 + k % clinics), "藥品": pick_drug(rnd),
+                "縣市1": CITIES[(k % clinics) % len(CITIES)], "庫存狀態": rnd.choice(["有貨", "有貨", "缺貨"]),
+                "給付條件": rnd.sample(PAYMENTS, rnd.randint(1, 2)), "是否上架": rnd.random() < 0.8, "備註": ""}),
+            FakeTable("DB_Requests", votes, lambda k, rnd: {
+                "許願者Email": f"user{k % 50000}@example.com", "所在縣市": rnd.choice(CITIES), "想要藥品": pick_drug(rnd)}),
+            FakeTable("DB_Feedback", feedback, lambda k, rnd: {
+                "機構代碼": str(3500000000 + rnd.randrange(clinics)), "藥品名稱": pick_drug(rnd), "回饋類型": rnd.choice(FEEDBACK_KINDS),
+                "備註": f"回報 {k}", "回報時間": "2026-01-01T00:00:00.000Z"}),
+            FakeTable("DB_Wishlist", 2, lambda k, rnd: [
+                {"建議藥名": "新藥A", "狀態": "待處理", "許願者Email": "a@example.com"},
+                {"建議藥名": "新藥B", "狀態": "已加入", "許願者Email": "b@example.com"}][k]),
+            FakeTable("DB_Supply_Inbox"),
+        ]}
+
+    def table(self, name):
+        with self.lock:
+            return self.tables.setdefault(name, FakeTable(name))
+
+    def add(self, table, values, keys=()):
+        with self.lock:
+            return self.tables.setdefault(table, FakeTable(table)).upsert(values, keys)
+
+    def admit(self):
+        """記錄一次請求；超過每秒上限時回傳 False"""
+        if self.latency: time.sleep(self.latency)
+        if not self.rate: return True
+        with self.lock:
+            now = time.time()
+            self.hits = [t for t in self.hits if now - t < 1]
+            if len(self.hits) >= self.rate:
+                self.requests["429"] += 1
+                return False
+            self.hits.append(now)
+            return True
+
+    def list_rows(self, table, query):
+        """回傳 Coda 格式的一頁 {'items', 'nextPageToken' 或 'nextSyncToken'}"""
+        token = json.loads(base64.urlsafe_b64decode(query["pageToken"])) if "pageToken" in query else None
+        with self.lock:
+            horizon = token["horizon"] if token else table.horizon()
+            since = token["since"] if token else int(query.get("syncToken") or 0)
+            cursor = tuple(token["cursor"]) if token else (0, 0)
+            limit = int(query.get("limit", 100))
+            match = None
+            if "query" in query:
+                col, _, val = query["query"].partition(":")
+                col, val = (json.loads(col) if col.startswith('"') else col), json.loads(val)
+                match = lambda row: row["values"].get(col) == val
+            items = []
+            for row, cursor in table.scan(since, horizon, cursor):
+                if match and not match(row): continue
+                items.append({k: v for k, v in row.items() if not k.startswith("_")})
+                if len(items) == limit: break
+            else:
+                return {"items": items, "nextSyncToken": str(horizon)}
+        state = {"since": since, "horizon": horizon, "cursor": cursor}
+        return {"items": items, "nextPageToken": base64.urlsafe_b64encode(json.dumps(state).encode()).decode()}
+
+    def serve(self, port=0):
+        """在背景執行緒啟動 HTTP 伺服器，回傳 (server, base_url)"""
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code, body, headers=None):
+                data = json.dumps(body, ensure_ascii=False).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for k, v in (headers or {}).items(): self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def target(self):
+                parts = [unquote(p) for p in urlparse(self.path).path.strip("/").split("/")]
+                if "tables" not in parts or parts[-1] != "rows":
+                    self.reply(404, {"message": "not found"})
+                    return None
+                return fake.table(parts[parts.index("tables") + 1])
+
+            def do_GET(self):
+                fake.requests["GET"] += 1
+                if not fake.admit(): return self.reply(429, {"message": "rate limited"}, {"Retry-After": "1"})
+                table = self.target()
+                if table is None: return
+                query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                self.reply(200, fake.list_rows(table, query))
+
+            def do_POST(self):
+                fake.requests["POST"] += 1
+                if not fake.admit(): return self.reply(429, {"message": "rate limited"}, {"Retry-After": "1"})
+                table = self.target()
+                if table is None: return
+                body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                keys = body.get("keyColumns") or ()
+                with fake.lock:
+                    added = [table.upsert({c["column"]: c["value"] for c in row["cells"]}, keys) for row in body["rows"]]
+                self.reply(202, {"requestId": f"mutate-{time.time_ns()}", "addedRowIds": [i for i in added if i]})
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-coda", daemon=True).start()
+        return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機 Coda rows API 替身")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--drugs", type=int, default=len(DRUGS))
+    parser.add_argument("--inventory", type=int, default=200)
+    parser.add_argument("--votes", type=int, default=500)
+    parser.add_argument("--feedback", type=int, default=200)
+    parser.add_argument("--clinics", type=int, default=300)
+    parser.add_argument("--latency", type=float, default=0.0, help="每個請求的固定延遲 (秒)")
+    parser.add_argument("--rate", type=int, default=0, help="每秒請求上限，超過回 429 (0 表示不限)")
+    args = parser.parse_args()
+    fake = FakeCoda(args.drugs, args.inventory, args.votes, args.feedback, args.clinics, args.latency, args.rate)
+    _, base = fake.serve(args.port)
+    print(f"fake Coda 已啟動：CODA_API_BASE = \"{base}\"")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()